@@ -0,0 +1,671 @@
+# benchmarks for the nomaden app, run from the repository root:
+#
+#   python bench.py render
+#   python bench.py views
+#   python bench.py login
+#   python bench.py outbox
+#   python bench.py suite [--scales 10,1000] [--backends pb,sqlite]
+#                         [--gunicorn] [--out FILE]
+#
+# the benchmarks work on generated data in a temporary directory and
+# drive the app through the flask test client, login runs gunicorn and
+# outbox a local smtpd.
+# suite runs all workloads on several data sets and writes a json
+# report, the data is the same on every run so reports of different
+# commits and storage backends can be compared. the -render workloads
+# bypass the page cache, gunicorn runs only the cached ones.
+
+import argparse
+import asyncore
+import datetime
+import httplib
+import json
+import os
+import random
+import shutil
+import smtpd
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from binascii import hexlify
+from hashlib import pbkdf2_hmac
+from uuid import UUID
+
+repo = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, repo)
+
+# where bench.py was started, before switching to the workdir
+start_dir = os.getcwd()
+
+# generated ids are the same on every run
+rng = random.Random(0)
+
+from nomads_pb2 import AppoinmentList, Appointment
+
+
+# switch to an empty data directory, the app reads its config and
+# users from the working directory
+def workdir():
+    tmp = tempfile.mkdtemp(prefix='nomaden-bench-')
+    shutil.copy(os.path.join(repo, 'nomaden.cfg'), tmp)
+    write_user('bench', b'secret', 1, os.path.join(tmp, 'users.txt'))
+    os.chdir(tmp)
+    return tmp
+
+
+def write_user(name, pw, rounds, path='users.txt'):
+    salt = os.urandom(32)
+    with open(path, 'w') as f:
+        f.write('sha256:{}:{}:{}:{}\n'.format(
+            hexlify(salt), rounds,
+            hexlify(pbkdf2_hmac('sha256', pw, salt, rounds)), name))
+
+
+def make_app(name, setdate=''):
+    app = Appointment()
+    app.id = str(UUID(int=rng.getrandbits(128), version=4))
+    app.name = name
+    app.street = 'Vogt-Koelln-Str. 30'
+    app.city = 'Hamburg'
+    app.publictrans = 'S Stellingen'
+    app.setdate = setdate
+    return app
+
+
+def write_schedule(waiting, fixed=4):
+    apps = AppoinmentList()
+    for i in range(fixed):
+        apps.apps.extend([make_app('Fix {}'.format(i),
+                                   '2030-01-{:02d}'.format(i + 1))])
+    for i in range(waiting):
+        apps.apps.extend([make_app('Kneipe {}'.format(i))])
+
+    for path in ('schedule.pb', 'journal.pb'):
+        if os.path.exists(path):
+            os.remove(path)
+    with open('schedule.pb', 'wb') as f:
+        f.write(apps.SerializeToString())
+
+
+# median wall time of fn in seconds
+def timeit(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+# time rendering / for growing waiting lists, the time per pub should
+# stay flat. the page cache is cleared before each request, otherwise
+# only the first one would render.
+def bench_render(sizes=(10, 100, 1000, 10000)):
+    import nomaden
+
+    client = nomaden.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = u'bench'
+        session['_fresh'] = True
+
+    print('{:>8} {:>12} {:>14}'.format('waiting', 'ms', 'us per pub'))
+    for size in sizes:
+        write_schedule(size)
+
+        def get():
+            nomaden.page_cache.clear()
+            res = client.get('/')
+            assert res.status_code == 200
+
+        get()
+        seconds = timeit(get, max(3, 3000 // size))
+        print('{:>8} {:>12.1f} {:>14.1f}'.format(
+            size, seconds * 1000, seconds * 1e6 / size))
+
+
+# size of an object including its instance dict
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+# build Appointment views of archived pubs and read the fields the
+# templates use, as /archive, /calendar and /poster do
+def bench_views(size=10000):
+    import nomaden
+
+    apps = AppoinmentList()
+    for i in range(size):
+        apps.apps.extend([make_app('Kneipe {}'.format(i), '2019-03-05')])
+
+    def build():
+        return [nomaden.Appointment(x, idx)
+                for idx, x in enumerate(apps.apps)]
+
+    def build_and_read():
+        for appo in build():
+            appo.name, appo.street, appo.setdate
+
+    print('{} appointments'.format(size))
+    print('construct only    {:8.1f} ms'.format(timeit(build, 5) * 1000))
+    print('construct + read  {:8.1f} ms'.format(
+        timeit(build_and_read, 5) * 1000))
+    print('bytes per object  {:8d}'.format(object_size(build()[0])))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# run the app in gunicorn with the worker count of the deployment
+def start_gunicorn(port, workers=3):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [repo] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.Popen(
+        [sys.executable, '-c',
+         'from gunicorn.app.wsgiapp import run; run()',
+         '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(port),
+         '--log-level', 'warning', 'wsgi:app'], env=env)
+
+    for i in range(100):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/about')
+            conn.getresponse().read()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+# time / while threads keep posting wrong passwords from many addresses,
+# the latency of / should hardly change
+def bench_login(storm=12, seconds=5, rounds=100000):
+    write_user('bench', b'secret', rounds)
+    write_schedule(100)
+
+    port = free_port()
+    proc = start_gunicorn(port)
+
+    def get_page(results):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        start = time.time()
+        conn.request('GET', '/')
+        conn.getresponse().read()
+        results.append(time.time() - start)
+
+    def measure():
+        results = []
+        end = time.time() + seconds
+        while time.time() < end:
+            get_page(results)
+        return results
+
+    statuses = {}
+    stop = []
+
+    def attack(n):
+        body = urllib.urlencode({'username': 'bench', 'password': 'wrong'})
+        while not stop:
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('POST', '/login', body, {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'X-Real-IP': '10.0.{}.{}'.format(n, len(stop))})
+            status = conn.getresponse().status
+            statuses[status] = statuses.get(status, 0) + 1
+
+    try:
+        quiet = measure()
+
+        threads = [threading.Thread(target=attack, args=(n,))
+                   for n in range(storm)]
+        for t in threads:
+            t.start()
+        loaded = measure()
+        stop.append(True)
+        for t in threads:
+            t.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print('{:>12} {:>8} {:>8} {:>8}'.format('', 'gets', 'p50 ms', 'p99 ms'))
+    for name, results in (('quiet', quiet), ('login storm', loaded)):
+        print('{:>12} {:>8} {:>8.1f} {:>8.1f}'.format(
+            name, len(results), percentile(results, 0.5) * 1000,
+            percentile(results, 0.99) * 1000))
+    print('login responses {}'.format(sorted(statuses.items())))
+
+
+# the tuesdays after today, like /schedulePubs picks them
+def next_tuesdays(count):
+    day = datetime.date.today() + datetime.timedelta(days=1)
+    while day.weekday() != 1:
+        day += datetime.timedelta(days=1)
+    return [day + datetime.timedelta(days=7 * i) for i in range(count)]
+
+
+def add_comments(app, count):
+    for i in range(count):
+        com = app.comments.add()
+        com.uname = 'Gast {}'.format(i)
+        com.text = 'Da war ich schon, gutes Bier und nette Leute. ' * 2
+        com.source = '127.0.0.1'
+
+
+# a data set of size waiting and archived pubs. the fixed pubs are on
+# the next four tuesdays so /schedulePubs has nothing to do after its
+# first run. the archive is written as archive.pb, as by import-old.py,
+# and split by the first request reading it.
+def write_dataset(size, comments):
+    rng.seed(size * 1000 + comments)
+    for name in os.listdir('.'):
+        if name.endswith(('.pb', '.pb.bak', '.pb.idx', '.tmp')) or\
+           name.startswith('nomaden.db'):
+            os.remove(name)
+        elif name in ('ics', 'digest', 'outbox'):
+            shutil.rmtree(name)
+
+    apps = AppoinmentList()
+    for idx, day in enumerate(next_tuesdays(4)):
+        apps.apps.extend([make_app('Fix {}'.format(idx), day.isoformat())])
+    for i in range(size):
+        app = make_app('Kneipe {}'.format(i))
+        add_comments(app, comments)
+        apps.apps.extend([app])
+    with open('schedule.pb', 'wb') as f:
+        f.write(apps.SerializeToString())
+
+    archive = AppoinmentList()
+    start = datetime.date(2010, 1, 5)
+    for i in range(size):
+        app = make_app('Alt {}'.format(i),
+                       (start + datetime.timedelta(days=7 * i)).isoformat())
+        add_comments(app, comments)
+        archive.apps.extend([app])
+    with open('archive.pb', 'wb') as f:
+        f.write(archive.SerializeToString())
+
+    return [x.id for x in apps.apps[4:]]
+
+
+# convert the data set to a storage backend and make the app use it, the
+# test client right away and gunicorn through the config it reads
+def use_backend(backend):
+    import nomaden
+
+    if backend != 'pb':
+        scheduled, archived = nomaden.ProtobufStorage().dump()
+        nomaden.STORAGE_BACKENDS[backend]().restore(scheduled, archived)
+
+    if not nomaden.config.has_section('storage'):
+        nomaden.config.add_section('storage')
+    nomaden.config.set('storage', 'backend', backend)
+    with open('nomaden.cfg', 'w') as f:
+        nomaden.config.write(f)
+
+    nomaden.storage_helper = nomaden.STORAGE_BACKENDS[backend]()
+    nomaden.add_save_hooks(nomaden.storage_helper)
+    nomaden.page_cache.clear()
+
+
+# the workloads of the suite, (name, function(waiting ids, n) returning
+# (method, path, form) of the n-th request, cached). read only ones come
+# first. the read only views are served from the page cache after the
+# first request, the -render workloads clear it before every request
+# to time loading and rendering.
+def workloads(crontoken):
+    def comment(ids, n):
+        return ('POST', '/comment', {'id': ids[n % len(ids)], 'magic': '4',
+                                     'author': 'bench', 'text': 'Prost'})
+
+    def move(ids, n):
+        direction = 'backward' if n % 2 == 0 else 'forward'
+        return ('GET', '/move?id={}&direction={}'.format(
+            ids[len(ids) // 2], direction), None)
+
+    index = lambda ids, n: ('GET', '/', None)
+    archive = lambda ids, n: ('GET', '/archive?page=2', None)
+    poster = lambda ids, n: ('GET', '/poster', None)
+
+    return [
+        ('index', index, True),
+        ('index-render', index, False),
+        ('archive', archive, True),
+        ('archive-render', archive, False),
+        ('calendar', lambda ids, n: ('GET', '/calendar', None), True),
+        ('poster', poster, True),
+        ('poster-render', poster, False),
+        ('comment', comment, True),
+        ('move', move, True),
+        ('schedulePubs', lambda ids, n: (
+            'GET', '/schedulePubs?token={}'.format(crontoken), None), True),
+    ]
+
+
+class TestClientDriver():
+
+    name = 'client'
+    concurrency = 1
+    # whether requests can bypass the page cache
+    uncached = True
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form, cached=True):
+        if not cached:
+            import nomaden
+            nomaden.page_cache.clear()
+        if method == 'POST':
+            return self.client.post(path, data=form).status_code
+        return self.client.get(path).status_code
+
+    def rss(self):
+        return rss_kb([os.getpid()])
+
+
+class GunicornDriver():
+
+    name = 'gunicorn'
+    # the page caches are in the workers
+    uncached = False
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.port = free_port()
+        self.proc = start_gunicorn(self.port)
+
+    def request(self, method, path, form, cached=True):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        if form is None:
+            conn.request(method, path)
+        else:
+            conn.request(method, path, urllib.urlencode(form), {
+                'Content-Type': 'application/x-www-form-urlencoded'})
+        res = conn.getresponse()
+        res.read()
+        conn.close()
+        return res.status
+
+    # master and workers
+    def rss(self):
+        pids = [self.proc.pid]
+        for pid in os.listdir('/proc'):
+            try:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, ValueError, IndexError):
+                continue
+            if ppid == self.proc.pid:
+                pids.append(int(pid))
+        return rss_kb(pids)
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+# resident set size of processes in KiB, None where /proc is missing
+def rss_kb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, ValueError):
+            return None
+    return total // 1024
+
+
+# run a workload for about seconds, at least min_requests times. the
+# first request runs alone and is reported apart, it fills the caches.
+def run_workload(driver, ids, request, seconds, min_requests=3,
+                 cached=True):
+    errors = []
+    latencies = []
+
+    def one(n):
+        method, path, form = request(ids, n)
+        start = time.time()
+        status = driver.request(method, path, form, cached)
+        latencies.append(time.time() - start)
+        if status >= 400:
+            errors.append(status)
+
+    one(0)
+    first = latencies.pop()
+
+    counter = [1]
+    lock = threading.Lock()
+    end = time.time() + seconds
+
+    def loop():
+        while True:
+            with lock:
+                n = counter[0]
+                if n > min_requests and time.time() > end:
+                    return
+                counter[0] += 1
+            one(n)
+
+    start = time.time()
+    threads = [threading.Thread(target=loop)
+               for i in range(driver.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'first_ms': round(first * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'rss_kb': driver.rss(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite():
+    parser = argparse.ArgumentParser(prog='bench.py suite')
+    parser.add_argument('--scales', default='10,1000,100000',
+                        help='pubs on the waiting list and in the archive')
+    parser.add_argument('--comments', type=int, default=10,
+                        help='comments per pub of the comment heavy sets, '
+                        '0 to leave them out')
+    parser.add_argument('--backends', default='pb,sqlite',
+                        help='storage backends to run the workloads on')
+    parser.add_argument('--seconds', type=float, default=2,
+                        help='time per workload')
+    parser.add_argument('--gunicorn', action='store_true',
+                        help='also run against gunicorn with 3 workers')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='parallel clients against gunicorn')
+    parser.add_argument('--out', default='bench-report.json')
+    args = parser.parse_args(sys.argv[2:])
+
+    datasets = []
+    for size in [int(x) for x in args.scales.split(',')]:
+        datasets.append(('{}'.format(size), size, 0))
+        if args.comments:
+            datasets.append(('{}-comments'.format(size), size, args.comments))
+
+    import nomaden
+    crontoken = nomaden.config.get('app', 'crontoken', 0)
+
+    runs = [(backend, dataset) for backend in args.backends.split(',')
+            for dataset in datasets]
+
+    results = []
+    print('{:>10} {:>8} {:>16} {:>14} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'driver', 'backend', 'data', 'workload', 'first ms', 'p50 ms',
+        'p99 ms', 'req/s', 'rss MiB'))
+    for driver_name in ['client'] + (['gunicorn'] if args.gunicorn else []):
+        for backend, (name, size, comments) in runs:
+            ids = write_dataset(size, comments)
+            use_backend(backend)
+            if driver_name == 'client':
+                driver = TestClientDriver(nomaden.app)
+            else:
+                driver = GunicornDriver(args.concurrency)
+
+            try:
+                for workload, request, cached in workloads(crontoken):
+                    if not cached and not driver.uncached:
+                        continue
+                    result = run_workload(driver, ids, request, args.seconds,
+                                          cached=cached)
+                    result.update({'driver': driver.name, 'backend': backend,
+                                   'dataset': name, 'size': size,
+                                   'comments': comments, 'workload': workload,
+                                   'cached': cached})
+                    results.append(result)
+                    print('{:>10} {:>8} {:>16} {:>14} {:>9.1f} {:>9.1f} '
+                          '{:>9.1f} {:>9.1f} {:>9}'.format(
+                              driver.name, backend, name, workload,
+                              result['first_ms'], result['p50_ms'],
+                              result['p99_ms'], result['throughput'],
+                              (result['rss_kb'] or 0) // 1024))
+            finally:
+                if driver_name == 'gunicorn':
+                    driver.close()
+
+    report = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'date': datetime.datetime.utcnow().isoformat(),
+        'seconds': args.seconds,
+        'results': results,
+    }
+    out = os.path.join(start_dir, args.out)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('report written to {}'.format(out))
+
+
+# a local mail server, fail is the count of mails it answers with a
+# temporary error before it accepts them again
+class MailServer(smtpd.SMTPServer):
+
+    def __init__(self, port):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', port), None)
+        self.received = []
+        self.fail = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.fail:
+            self.fail -= 1
+            return '451 try again later'
+        self.received.append((time.time(), data))
+
+
+# time from queueing a mail to its delivery by a local smtpd: while
+# the server is down, after it came up while an earlier mail waits for
+# its retry, and after a temporary error. a new mail must not wait for
+# the retry of an earlier one.
+def bench_outbox(retry=5, timeout=30):
+    port = free_port()
+    with open('nomaden.cfg') as f:
+        cfg = f.read()
+    with open('nomaden.cfg', 'w') as f:
+        f.write(cfg.replace('port = 25', 'port = {}'.format(port)))
+
+    import nomaden
+    nomaden.MAIL_RETRY = retry
+    outbox = nomaden.outbox
+
+    def queue(subject):
+        start = time.time()
+        outbox.enqueue('bench@example.org', ['nomaden@example.org'],
+                       'Subject: {}\n\nProst'.format(subject))
+        return start, time.time() - start
+
+    def delivered(subject):
+        end = time.time() + timeout
+        while time.time() < end:
+            for at, data in server.received:
+                if 'Subject: {}'.format(subject) in data:
+                    return at
+            time.sleep(0.01)
+        raise RuntimeError('{} was not delivered'.format(subject))
+
+    # A fails, the server is not there yet
+    a_start, a_queue = queue('A')
+    while not outbox.queued() or outbox.queued()[0][1].attempts < 1:
+        time.sleep(0.01)
+
+    server = MailServer(port)
+    loop = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+    loop.daemon = True
+    loop.start()
+
+    # B goes out right away, A on its retry
+    b_start, b_queue = queue('B')
+    b_sent = delivered('B') - b_start
+    a_sent = delivered('A') - a_start
+
+    # C gets a temporary error and goes out on its retry
+    server.fail = 1
+    c_start, c_queue = queue('C')
+    c_sent = delivered('C') - c_start
+
+    print('{:>34} {:>10} {:>12}'.format('mail', 'queue ms', 'delivered s'))
+    for name, queued, sent in (
+            ('A, queued while the server is down', a_queue, a_sent),
+            ('B, queued while A waits', b_queue, b_sent),
+            ('C, temporary error', c_queue, c_sent)):
+        print('{:>34} {:>10.1f} {:>12.2f}'.format(name, queued * 1000, sent))
+
+    assert b_sent < 1, 'B waited for the retry of A'
+    # retries are due at whole seconds
+    assert a_sent >= retry - 1 and c_sent >= retry - 1
+    assert outbox.queued() == []
+
+
+benchmarks = {
+    'render': bench_render,
+    'views': bench_views,
+    'login': bench_login,
+    'outbox': bench_outbox,
+    'suite': bench_suite,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('usage: bench.py {}'.format('|'.join(sorted(benchmarks))))
+        sys.exit(1)
+
+    tmp = workdir()
+    try:
+        benchmarks[sys.argv[1]]()
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,116 @@
+# import, export and convert pubs between file formats one pub at a
+# time, so files of any size are converted in constant memory, e.g.
+#
+#   python convert-pubs.py pb jsonl archive.pb.bak archive.jsonl
+#   python convert-pubs.py csv pb pubs.csv archive.pb
+#
+# the formats are
+#
+#   pb         an AppoinmentList, like archive.pb and schedule.pb
+#   delimited  one length delimited Appointment after the other
+#   jsonl      one Appointment as json per line
+#   csv        one pub per line with a header line, without comments
+#
+# input and output default to stdin and stdout. moving a pb file to
+# archive.pb in the data directory imports the pubs into the archive like
+# import-old.py does, the app splits it into its archive segments.
+
+import csv
+import json
+import sys
+
+from google.protobuf import json_format
+
+import pbrecords
+from nomads_pb2 import Appointment
+
+CSV_FIELDS = ['id', 'name', 'street', 'city', 'publictrans', 'source',
+              'entered', 'setdate', 'removed']
+
+
+def read_pb(f):
+    for number, data in pbrecords.read_fields(f):
+        if number == 1:
+            yield Appointment.FromString(data)
+
+
+def read_delimited(f):
+    for data in pbrecords.read_delimited(f):
+        yield Appointment.FromString(data)
+
+
+def read_jsonl(f):
+    for line in f:
+        if line.strip():
+            yield json_format.ParseDict(json.loads(line), Appointment())
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        pbapp = Appointment()
+        for field in CSV_FIELDS:
+            if row.get(field):
+                setattr(pbapp, field, row[field].decode('utf-8'))
+        yield pbapp
+
+
+def write_pb(f, pbapps):
+    for pbapp in pbapps:
+        f.write(pbrecords.tagged(1, pbapp))
+        yield pbapp
+
+
+def write_delimited(f, pbapps):
+    for pbapp in pbapps:
+        f.write(pbrecords.delimited(pbapp))
+        yield pbapp
+
+
+def write_jsonl(f, pbapps):
+    for pbapp in pbapps:
+        f.write(json.dumps(json_format.MessageToDict(
+            pbapp, preserving_proto_field_name=True), sort_keys=True) + '\n')
+        yield pbapp
+
+
+def write_csv(f, pbapps):
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
+    for pbapp in pbapps:
+        writer.writerow([getattr(pbapp, field).encode('utf-8')
+                         for field in CSV_FIELDS])
+        yield pbapp
+
+
+FORMATS = {
+    'pb': (read_pb, write_pb),
+    'delimited': (read_delimited, write_delimited),
+    'jsonl': (read_jsonl, write_jsonl),
+    'csv': (read_csv, write_csv),
+}
+
+
+def main(argv):
+    formats = sorted(FORMATS)
+    if not 3 <= len(argv) <= 5 or argv[1] not in formats or\
+       argv[2] not in formats:
+        sys.stderr.write('usage: convert-pubs.py {0} {0} [INPUT [OUTPUT]]\n'
+                         .format('|'.join(formats)))
+        return 1
+
+    read = FORMATS[argv[1]][0]
+    write = FORMATS[argv[2]][1]
+    src = open(argv[3], "rb") if len(argv) > 3 else sys.stdin
+    dst = open(argv[4], "wb") if len(argv) > 4 else sys.stdout
+
+    count = 0
+    for pbapp in write(dst, read(src)):
+        count += 1
+    dst.flush()
+
+    sys.stderr.write('converted {} pubs\n'.format(count))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
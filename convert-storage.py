@@ -0,0 +1,42 @@
+# convert the stored pubs from one storage backend to the other, e.g.
+#
+#   python convert-storage.py pb sqlite
+#
+# run it in the data directory while the app is stopped. the target
+# must not hold any data yet. afterwards set backend in the storage
+# section of nomaden.cfg to the target.
+#
+# the source is upgraded in place first, like the app does on its first
+# start: comments kept in the pubs move to comments.pb, which both
+# backends share, and a pb archive.pb is split into year segments and
+# renamed to archive.pb.bak. the pubs themselves are left as they are,
+# so the source can still be switched back to, but not by versions
+# older than these upgrades.
+
+import sys
+
+import nomaden
+
+
+def main(argv):
+    backends = sorted(nomaden.STORAGE_BACKENDS)
+    if len(argv) != 3 or argv[1] not in backends or\
+       argv[2] not in backends or argv[1] == argv[2]:
+        print('usage: convert-storage.py {0} {0}'.format('|'.join(backends)))
+        return 1
+
+    source = nomaden.STORAGE_BACKENDS[argv[1]]()
+    target = nomaden.STORAGE_BACKENDS[argv[2]]()
+    if target.exists():
+        print('there is {} data already, move it away first'.format(argv[2]))
+        return 1
+
+    scheduled, archived = source.dump()
+    target.restore(scheduled, archived)
+    print('converted {} scheduled and {} archived pubs'.format(
+        len(scheduled), len(archived)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,4 +1,14 @@
 #!/bin/sh
+DATA=/home/nomaden/nomaden-termine
+FILES="$DATA/*.pb"
+
+# the database of the sqlite backend can't be copied as a file while
+# the app writes to it, back up a consistent copy made by sqlite
+if [ -f "$DATA/nomaden.db" ]; then
+	sqlite3 "$DATA/nomaden.db" ".backup '$DATA/nomaden-backup.db'" || exit 1
+	FILES="$FILES $DATA/nomaden-backup.db"
+fi
+
 /usr/bin/tarsnap -c \
 		 -f "$(uname -n)-$(date +%Y-%m-%d_%H-%M-%S)" \
-		 /home/nomaden/nomaden-termine/*.pb
+		 $FILES
@@ -1,21 +1,24 @@
-from nomads_pb2 import AppoinmentList, Appointment
+from nomads_pb2 import Appointment
 from datetime import datetime
+import os
 import requests
 import re
 
+import pbrecords
+
 
 # this is a simple scraping script for the archived appointments
-# from the old nomaden.org site
+# from the old nomaden.org site. the appointments are written to
+# archive.pb as they come in, the app splits it into its archive.
 
 
 def scrape_url(url, cb):  
-    r = requests.get(url)
+    r = requests.get(url, stream=True)
 
     if r.status_code == requests.codes.ok:
         r.encoding = 'utf-8'
-        txt = r.text
 
-        for line in txt.split('\n'):
+        for line in r.iter_lines(decode_unicode=True):
             m = re.match(ur'^([0-9]{2}\.[0-9]{2}\.[0-9]{4}, .*)<BR>$',
                          line)
             if m:
@@ -31,29 +34,28 @@ def scrape_url(url, cb):
                    addr.encode('utf-8'))
 
 
-applis = AppoinmentList()
-
-
 def convert_date(datum):
     return datetime.strptime(datum, "%d.%m.%Y").isoformat()
 
 
-def put_appointment(datum, name, addr):
-    app = Appointment()
-    app.name = name
-    app.street = addr
-    app.setdate = convert_date(datum)
-    app.source = "import"
-    applis.apps.extend([ app ])
+# an AppoinmentList written one appointment at a time
+def put_appointment(f):
+    def put(datum, name, addr):
+        app = Appointment()
+        app.name = name
+        app.street = addr
+        app.setdate = convert_date(datum)
+        app.source = "import"
+        f.write(pbrecords.tagged(1, app))
+    return put
 
 
 def import_old():
-    scrape_url("http://www.nomaden.org/cgi-bin/termine/olddates.cgi",
-               put_appointment)
-
-    with open("archive.pb", "wb") as f:
-        f.write(applis.SerializeToString())
+    with open("archive.pb.tmp", "wb") as f:
+        scrape_url("http://www.nomaden.org/cgi-bin/termine/olddates.cgi",
+                   put_appointment(f))
     f.close()
+    os.rename("archive.pb.tmp", "archive.pb")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+# structured logging: records are formatted as json lines and handed to
+# a thread that writes them, so logging never blocks a request on disk
+# or on the terminal. python 2 has no QueueHandler, this is a small one.
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import threading
+import Queue
+
+# attributes every LogRecord has, everything else was passed with
+# extra= and goes into the line
+RECORD_FIELDS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) |\
+    set(['message', 'asctime'])
+
+
+# one json object per record with time, level, logger and message plus
+# the fields passed with extra=, e.g.
+#   app.logger.info('pub moved', extra={'op': 'move', 'id': appid})
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {
+            'time': datetime.datetime.utcfromtimestamp(
+                record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_FIELDS:
+                line[key] = value
+        if record.exc_info:
+            line['exc'] = self.formatException(record.exc_info)
+        return json.dumps(line, sort_keys=True, default=repr)
+
+
+# formats records in the calling thread and queues them for handlers
+# run by a background thread. if the queue is full records are dropped
+# and counted instead of waiting. the thread is started in every
+# process using the handler, so it also works in forked workers.
+class QueueHandler(logging.Handler):
+
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.queue = None
+        self.pid = None
+        self.dropped = 0
+        self.start_lock = threading.Lock()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            record.msg = self.format(record)
+            record.args = None
+            record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.maxsize)
+            writer = threading.Thread(target=self.run, args=(self.queue,))
+            writer.daemon = True
+            writer.start()
+            atexit.register(self.drain, self.queue)
+            self.pid = os.getpid()
+
+    def run(self, queue):
+        while True:
+            self.write(queue.get())
+
+    # write what is left in the queue, e.g. at exit
+    def drain(self, queue):
+        while True:
+            try:
+                record = queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.write(record)
+
+    def write(self, record):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.makeLogRecord({
+                'name': record.name, 'levelno': logging.WARNING,
+                'levelname': 'WARNING', 'msg': 'dropped %d log records',
+                'args': (dropped,)})
+            warning.msg = self.format(warning)
+            warning.args = None
+            self.write(warning)
+
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
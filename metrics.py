@@ -0,0 +1,198 @@
+# counters and histograms shared by all workers through a memory mapped
+# file. every counter and histogram bucket is a double at a fixed
+# offset. the layout follows from the declared metrics, so all workers
+# running the same code agree on it. every layout gets a file of its
+# own, e.g. metrics-<tag>.bin, so workers of an older version still
+# running during a restart keep theirs. the files are never truncated,
+# touching a mapping of a truncated file kills the process with
+# SIGBUS. updates are collected in memory and added to the file under
+# lockf in one go by flush().
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from binascii import hexlify
+from hashlib import sha1
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# label value of observations with a value that was not declared
+OTHER = 'other'
+
+SLOT = struct.Struct('<d')
+HEADER = 8
+
+
+class Metrics():
+
+    def __init__(self, path):
+        self.path = path
+        # (name, kind, help, label name, label values)
+        self.declared = []
+        # (name, label value) -> first slot
+        self.slots = None
+        self.size = 0
+        # (name, label value, slot offset) -> value to add
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file = None
+        self.map = None
+
+    # label values may be a function, it is called once the layout is
+    # needed, e.g. to list the routes after they were all registered
+    def counter(self, name, help, label=None, values=()):
+        self.declared.append((name, 'counter', help, label, values))
+
+    def histogram(self, name, help, label=None, values=()):
+        self.declared.append((name, 'histogram', help, label, values))
+
+    def inc(self, name, value=1, label=None):
+        with self.lock:
+            key = (name, label, 0)
+            self.pending[key] = self.pending.get(key, 0) + value
+
+    def observe(self, name, seconds, label=None):
+        bucket = len(BUCKETS)
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                bucket = idx
+                break
+
+        with self.lock:
+            for key, value in (((name, label, bucket), 1),
+                               ((name, label, len(BUCKETS) + 1), seconds),
+                               ((name, label, len(BUCKETS) + 2), 1)):
+                self.pending[key] = self.pending.get(key, 0) + value
+
+    def layout(self):
+        if self.slots is not None:
+            return
+
+        slots = {}
+        size = 0
+        declared = []
+        for name, kind, help, label, values in self.declared:
+            if callable(values):
+                values = values()
+            values = list(values) + [OTHER] if label else [None]
+            declared.append((name, kind, help, label, values))
+            width = 1 if kind == 'counter' else len(BUCKETS) + 3
+            for value in values:
+                slots[(name, value)] = size
+                size += width
+
+        self.declared = declared
+        self.size = size
+        self.slots = slots
+
+    # the file of a layout, the tag goes before the extension of path
+    def layout_path(self, tag):
+        root, ext = os.path.splitext(self.path)
+        return '{}-{}{}'.format(root, hexlify(tag), ext)
+
+    # map the file of the layout, it is created if it is missing
+    def open(self):
+        self.layout()
+        if self.pid == os.getpid():
+            return
+
+        tag = sha1(repr((BUCKETS, [(x[0], x[1], x[4])
+                                   for x in self.declared]))
+                   .encode('utf-8')).digest()[:HEADER]
+        length = HEADER + SLOT.size * self.size
+        content = tag + b'\0' * (length - HEADER)
+
+        f = open(self.layout_path(tag), "a+b")
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            # only this layout is ever written to the file, a file cut
+            # short by a crash while it was set up is completed
+            size = os.fstat(f.fileno()).st_size
+            if size < length:
+                f.write(content[size:])
+                f.flush()
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+        self.map = mmap.mmap(f.fileno(), length)
+        self.file = f
+        self.pid = os.getpid()
+
+    # add the pending updates to the file
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if not pending:
+            return
+
+        self.open()
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        try:
+            for (name, label, offset), value in pending.items():
+                slot = self.slots.get((name, label))
+                if slot is None:
+                    slot = self.slots.get((name, OTHER))
+                if slot is None:
+                    continue
+                pos = HEADER + SLOT.size * (slot + offset)
+                SLOT.pack_into(self.map, pos,
+                               SLOT.unpack_from(self.map, pos)[0] + value)
+        finally:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+
+    # the metrics of all workers in the prometheus text format
+    def export(self):
+        self.flush()
+        self.open()
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        try:
+            data = self.map[:]
+        finally:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+
+        def value(slot):
+            return SLOT.unpack_from(data, HEADER + SLOT.size * slot)[0]
+
+        def labels(pairs):
+            pairs = [(k, v) for k, v in pairs if k is not None]
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, escape(v))
+                                  for k, v in pairs) + '}'
+
+        lines = []
+        for name, kind, help, label, values in self.declared:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for val in values:
+                slot = self.slots[(name, val)]
+                if kind == 'counter':
+                    lines.append('{}{} {!r}'.format(
+                        name, labels([(label, val)]), value(slot)))
+                    continue
+
+                count = 0
+                for idx, bound in enumerate(BUCKETS + ('+Inf',)):
+                    count += value(slot + idx)
+                    lines.append('{}_bucket{} {!r}'.format(
+                        name, labels([(label, val), ('le', str(bound))]),
+                        count))
+                lines.append('{}_sum{} {!r}'.format(
+                    name, labels([(label, val)]),
+                    value(slot + len(BUCKETS) + 1)))
+                lines.append('{}_count{} {!r}'.format(
+                    name, labels([(label, val)]),
+                    value(slot + len(BUCKETS) + 2)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
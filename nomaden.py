@@ -1,4 +1,5 @@
 import logging
+from functools import wraps
 from logging.handlers import RotatingFileHandler
 
 from flask import Flask, render_template, request, redirect, url_for,\
@@ -7,23 +8,36 @@ from flask import Flask, render_template, request, redirect, url_for,\
 from flask_login import LoginManager, current_user, login_required,\
     login_user, logout_user
 
-from hashlib import pbkdf2_hmac
-from binascii import unhexlify
+from hashlib import pbkdf2_hmac, sha1
+from hmac import compare_digest
+from binascii import hexlify, unhexlify, crc32
 
-from smtplib import SMTP
-from email.mime.text import MIMEText
+from jinja2 import Template, TemplateNotFound, FileSystemBytecodeCache
 
+import collections
 import datetime
-import pytz
-import dateutil.parser
 import re
 import os.path
 import fcntl
+import mmap
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from uuid import uuid4 as uuid
 
-from ics import Calendar, Event
+# ics, pytz, smtplib, email and dateutil are imported where they are
+# used. only calendars, mails and odd dates need them, importing them
+# here made every worker start slower.
+
 from nomads_pb2 import AppoinmentList as PBAppointmentList,\
-    Appointment as PBAppointment
+    Appointment as PBAppointment, JournalEntry as PBJournalEntry,\
+    ArchiveIndex as PBArchiveIndex, OutgoingMail as PBOutgoingMail,\
+    CommentRecord as PBCommentRecord
+import pbrecords
+from metrics import Metrics
+from jsonlog import JsonFormatter, QueueHandler
 
 import ConfigParser
 
@@ -42,127 +56,1521 @@ login_manager.init_app(app)
 app.secret_key = config.get("app", "secret", 0)
 
 
-# gunicorn logging
+# logging, json lines handed to the gunicorn handlers or to the log
+# file by a background thread
+
+queue_handler = QueueHandler([])
+queue_handler.setFormatter(JsonFormatter())
 
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
+    queue_handler.handlers = gunicorn_logger.handlers
+    app.logger.handlers = [queue_handler]
     app.logger.setLevel(gunicorn_logger.level)
 
 
+# log a mutation of a pub with its id and duration as fields
+def log_op(op, appid, start, **fields):
+    if app.logger.isEnabledFor(logging.INFO):
+        fields.update(op=op, id=appid,
+                      duration_ms=round((time.time() - start) * 1000, 3))
+        app.logger.info('%s %s', op, appid, extra=fields)
+
+
+# metrics, shared by the workers in a file named after METRICS and
+# served on /metrics
+
+METRICS = "metrics.bin"
+
+metrics = Metrics(METRICS)
+metrics.histogram('nomaden_request_seconds', 'Time to handle a request',
+                  'endpoint', lambda: sorted(app.view_functions))
+metrics.histogram('nomaden_template_seconds', 'Time to render a template',
+                  'template', lambda: sorted(app.jinja_env.list_templates()))
+metrics.histogram('nomaden_lock_wait_seconds', 'Time waiting for a lock',
+                  'lock', ('storage', 'login', 'outbox'))
+metrics.histogram('nomaden_pbkdf2_seconds', 'Time to hash a password')
+metrics.counter('nomaden_storage_loads_total', 'Schedules loaded')
+metrics.counter('nomaden_storage_parses_total', 'Data files parsed')
+metrics.counter('nomaden_storage_saves_total', 'Saves appended to the journal')
+metrics.counter('nomaden_storage_read_bytes_total',
+                'Bytes read from data files')
+metrics.counter('nomaden_storage_written_bytes_total',
+                'Bytes written to data files')
+
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            metrics.observe('nomaden_template_seconds', time.time() - start,
+                            self.name)
+
+
+app.jinja_env.template_class = TimedTemplate
+
+
+# templates compiled once and shared by the workers on disk. written
+# to a temporary file first, a worker never loads half written
+# bytecode of another. jinja checks the template source, so changed
+# templates are compiled again.
+class TemplateCache(FileSystemBytecodeCache):
+
+    def dump_bytecode(self, bucket):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another worker meanwhile
+                pass
+
+        path = self._get_cache_filename(bucket)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            bucket.write_bytecode(f)
+        f.close()
+        os.rename(tmp, path)
+
+
+TEMPLATE_CACHE = "template-cache"
+
+app.jinja_env.bytecode_cache = TemplateCache(TEMPLATE_CACHE)
+
+
 # model layer
 
 
-class StorageHelper():
+SCHEDULE = "schedule.pb"
+ARCHIVE_INDEX = "archive-index.pb"
+JOURNAL = "journal.pb"
+STORAGE_LOCK = "storage.lock"
 
-    archive = None
-    schedule = None
+# the archive as a single list, before it was split into years
+LEGACY_ARCHIVE = "archive.pb"
 
-    def __init__(self):
-        pass
+# fold the journal into the snapshots once it grew beyond this size
+COMPACT_BYTES = 64 * 1024
+
+# archived pubs shown per page
+ARCHIVE_PAGE = 50
+
+# the comments of all pubs, kept apart from the schedule
+COMMENTS = "comments.pb"
+
+# latest comments shown per pub on the main page
+COMMENTS_SHOWN = 5
+
+# the pubs of the sqlite storage backend
+DATABASE = "nomaden.db"
+
+# journal entries kept in the database for workers to catch up with
+SQLITE_JOURNAL_KEEP = 1000
+
+# the calendars of the fixed pubs, served from here by nginx
+ICS_DIR = "ics"
+ICS_FEED = "nomaden.ics"
 
+
+# The scheduled pubs in their order, indexed by id. The order is a
+# list of the pub messages, moving a pub only moves references. Copies
+# of the schedule share the pubs, a pub is copied before it is changed.
+class Schedule():
+
+    def __init__(self, apps, version=0):
+        self.apps = list(apps)
+        # seq of the last journal entry contained
+        self.version = version
+        # id -> position in apps
+        self.positions = dict((pbapp.id, idx)
+                              for idx, pbapp in enumerate(self.apps))
+        # ids of the pubs no other schedule refers to
+        self.owned = set()
+
+    def copy(self):
+        schedule = Schedule([], self.version)
+        schedule.apps = list(self.apps)
+        schedule.positions = dict(self.positions)
+        # the pubs are shared from now on
+        self.owned = set()
+        return schedule
+
+    # the pub at index, ready to be changed
+    def mutable(self, index):
+        pbapp = self.apps[index]
+        if pbapp.id not in self.owned:
+            pbapp = PBAppointment()
+            pbapp.CopyFrom(self.apps[index])
+            self.apps[index] = pbapp
+            self.owned.add(pbapp.id)
+        return pbapp
+
+    def to_message(self):
+        message = PBAppointmentList(version=self.version)
+        message.apps.extend(self.apps)
+        return message
+
+    def find(self, appid):
+        return self.positions.get(appid)
+
+    def append(self, pbapp):
+        copy = PBAppointment()
+        copy.CopyFrom(pbapp)
+        self.apps.append(copy)
+        self.positions[copy.id] = len(self.apps) - 1
+        self.owned.add(copy.id)
+
+    def remove(self, index):
+        del self.positions[self.apps[index].id]
+        del self.apps[index]
+        for idx in range(index, len(self.apps)):
+            self.positions[self.apps[idx].id] = idx
+
+    def swap(self, index, other):
+        apps = self.apps
+        apps[index], apps[other] = apps[other], apps[index]
+
+        self.positions[apps[index].id] = index
+        self.positions[apps[other].id] = other
+
+    def waiting_ids(self):
+        return [pbapp.id for pbapp in self.apps if pbapp.setdate == '']
+
+    # put the waiting pubs in the given order, into the places waiting
+    # pubs take now
+    def reorder_waiting(self, order):
+        slots = [idx for idx, pbapp in enumerate(self.apps)
+                 if pbapp.setdate == '']
+        waiting = dict((self.apps[idx].id, self.apps[idx]) for idx in slots)
+
+        ids = waiting_order([self.apps[idx].id for idx in slots], order)
+        for idx, appid in zip(slots, ids):
+            self.apps[idx] = waiting[appid]
+            self.positions[appid] = idx
+
+
+# the ids of the waiting pubs in the given order. ids of pubs that are
+# not waiting are skipped, waiting pubs missing from order follow in
+# their current order.
+def waiting_order(waiting, order):
+    rest = set(waiting)
+    ids = []
+    for appid in order:
+        if appid in rest:
+            rest.remove(appid)
+            ids.append(appid)
+    ids.extend(appid for appid in waiting if appid in rest)
+    return ids
+
+
+def update_fields(pbapp, update):
+    for field in ('name', 'street', 'city', 'publictrans', 'source'):
+        setattr(pbapp, field, getattr(update, field))
+
+    for field in ('entered', 'setdate', 'removed'):
+        if getattr(update, field) != '':
+            setattr(pbapp, field, getattr(update, field))
+
+
+# apply a journal entry to the schedule
+def apply_to_schedule(schedule, entry):
+    if entry.op == PBJournalEntry.ENTER:
+        schedule.append(entry.app)
+        return
+    if entry.op == PBJournalEntry.REORDER:
+        schedule.reorder_waiting(entry.order)
+        return
+
+    index = schedule.find(entry.id)
+    if index is None:
+        return
+
+    if entry.op == PBJournalEntry.UPDATE:
+        update_fields(schedule.mutable(index), entry.app)
+    elif entry.op == PBJournalEntry.COMMENT:
+        schedule.mutable(index).comments.extend([entry.comment])
+    elif entry.op == PBJournalEntry.MOVE:
+        other = index + entry.delta
+        if 0 <= other < len(schedule.apps):
+            schedule.swap(index, other)
+    elif entry.op == PBJournalEntry.MOVE_TO:
+        if schedule.apps[index].setdate == '':
+            order = schedule.waiting_ids()
+            order.remove(entry.id)
+            order.insert(entry.position, entry.id)
+            schedule.reorder_waiting(order)
+    elif entry.op in (PBJournalEntry.ARCHIVE, PBJournalEntry.DELETE):
+        schedule.remove(index)
+
+
+def archive_year(pbapp):
+    if pbapp.setdate == '':
+        return 0
+    return int(pbapp.setdate[:4])
+
+
+def segment_path(year):
+    return "archive-{:04d}.pb".format(year)
+
+
+# the offsets of the pubs in a data file, see pbrecords.record_index
+def index_path(path):
+    return path + ".idx"
+
+
+# write a file so that readers either see the old or the new content.
+# the file keeps its mode, e.g. users.txt stays readable by its owner
+# only.
+def write_atomic(path, data):
+    with atomic_file(path) as f:
+        f.write(data)
+
+
+# like write_atomic for a file written piece by piece in the block
+@contextmanager
+def atomic_file(path):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = None
+
+    with open(tmp, "wb") as f:
+        # before anything is written to it
+        if mode is not None:
+            os.fchmod(f.fileno(), mode)
+        yield f
+        metrics.inc('nomaden_storage_written_bytes_total', f.tell())
+        f.flush()
+        os.fsync(f.fileno())
+    f.close()
+    os.rename(tmp, path)
+
+    dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+# the content of a file, None if it doesn't exist
+def read_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+# a snapshot file with the journal replayed on top
+class StoreState():
+
+    def __init__(self, key, apps, seq, journal=None, offset=0, dirty=False):
+        # file key of the snapshot
+        self.key = key
+        self.apps = apps
+        # seq of the last journal entry contained in apps
+        self.seq = seq
+        # id of the journal and how far it has been replayed
+        self.journal = journal
+        self.offset = offset
+        # whether the replayed entries changed apps
+        self.dirty = dirty
+
+
+# Storage of the pubs, shared by the backends. A request loads the
+# schedule once, its mutations are applied to a copy of it right away
+# and recorded as journal entries, which save() writes out. The loaded
+# schedule is cached by the backends and shared by all requests served
+# by a worker.
+#
+# A backend provides load(), save(), generation(), get_archive_index(),
+# get_archived() and migrate_comments(), and for convert-storage.py
+# exists(), dump() and restore().
+class StorageHelper():
+
+    def __init__(self):
+        # path -> StoreState, the schedule is kept under SCHEDULE
+        self.cache = {}
+        # lockf locks are per process, threads need their own
+        self.thread_lock = threading.Lock()
+        # called with the saved schedule while the lock is still held
+        self.save_hooks = []
+
+    # serializes writers across threads and workers
+    @contextmanager
+    def exclusive(self):
+        start = time.time()
+        with self.thread_lock:
+            with open(STORAGE_LOCK, "a") as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                metrics.observe('nomaden_lock_wait_seconds',
+                                time.time() - start, 'storage')
+                yield
+
+    # identifies one version of a data file
+    def file_key(self, st):
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def snapshot_key(self, path):
+        try:
+            return self.file_key(os.stat(path))
+        except OSError:
+            return None
+
+    # utc time of the last change in a generation, None if empty or if
+    # it is less than a second ago. http dates are whole seconds, a
+    # client couldn't tell it from a later change in the same second,
+    # until then only the etag is used.
+    def last_modified(self, generation):
+        mtimes = [key[2] for key in generation if key is not None]
+        if not mtimes or time.time() - max(mtimes) < 1:
+            return None
+        return datetime.datetime.utcfromtimestamp(int(max(mtimes)))
+
+    # the schedule of this request, save() can tell from the seq it was
+    # loaded at whether other workers saved meanwhile
     def get_scheduled(self):
         scheduled = getattr(flask_g, 'scheduled_apps', None)
         if not scheduled:
-            scheduled = PBAppointmentList()
-            if os.path.isfile("schedule.pb"):
-                with open("schedule.pb", "rb") as f:
-                    fcntl.lockf(f, fcntl.LOCK_SH)
-                    scheduled.ParseFromString(f.read())
-                f.close()
+            scheduled = self.load()
+            flask_g.loaded_seq = self.cache[SCHEDULE].seq
         flask_g.scheduled_apps = scheduled
         return scheduled
 
-    def get_archived(self):
-        archived = getattr(flask_g, 'archived_apps', None)
-        if not archived:
-            archived = PBAppointmentList()
-            if os.path.isfile("archive.pb"):
-                with open("archive.pb", "rb") as f:
-                    fcntl.lockf(f, fcntl.LOCK_SH)
-                    archived.ParseFromString(f.read())
-                f.close()
-        flask_g.archived_apps = archived
-        return archived
+    # copy on write, a request gets its own copy of the schedule before
+    # changing it, the cached one is shared with other requests
+    def writable(self):
+        scheduled = self.get_scheduled()
+        state = self.cache.get(SCHEDULE)
+        if state is not None and scheduled is state.apps:
+            scheduled = state.apps.copy()
+            flask_g.scheduled_apps = scheduled
+        return scheduled
 
-    def save(self):
-        scheduled = getattr(flask_g, 'scheduled_apps', None)
-        if scheduled:
-            with open("schedule.pb", "wb") as f:
-                fcntl.lockf(f, fcntl.LOCK_EX)
-                f.write(scheduled.SerializeToString())
+    # apply a mutation to the schedule of this request and remember it
+    # for the journal, save() writes it out
+    def record(self, entry):
+        apply_to_schedule(self.writable(), entry)
+
+        pending = getattr(flask_g, 'journal_pending', [])
+        pending.append(entry)
+        flask_g.journal_pending = pending
+
+    def find(self, appid):
+        return self.get_scheduled().find(appid)
+
+    # enter a new pub or update the fields of an existing one
+    def put(self, pbapp):
+        entry = PBJournalEntry()
+        if self.find(pbapp.id) is None:
+            entry.op = PBJournalEntry.ENTER
+        else:
+            entry.op = PBJournalEntry.UPDATE
+        entry.id = pbapp.id
+        entry.app.CopyFrom(pbapp)
+        self.record(entry)
+
+    # swap a pub with the one delta places away, False if there is none
+    def move(self, appid, delta):
+        index = self.find(appid)
+        if index is None or\
+           not 0 <= index + delta < len(self.get_scheduled().apps):
+            return False
+
+        self.record(PBJournalEntry(op=PBJournalEntry.MOVE, id=appid,
+                                   delta=delta))
+        return True
+
+    # move a waiting pub to position on the waiting list, counted from 0,
+    # False if it is not waiting
+    def move_to(self, appid, position):
+        index = self.find(appid)
+        if index is None or self.get_scheduled().apps[index].setdate != '':
+            return False
+
+        self.record(PBJournalEntry(op=PBJournalEntry.MOVE_TO, id=appid,
+                                   position=position))
+        return True
+
+    # put the waiting list in the order of the given ids
+    def reorder(self, order):
+        entry = PBJournalEntry(op=PBJournalEntry.REORDER)
+        entry.order.extend(order)
+        self.record(entry)
+
+    # move a pub from the schedule to the archive
+    def archive(self, appid):
+        index = self.find(appid)
+        if index is None:
+            return False
+
+        entry = PBJournalEntry(op=PBJournalEntry.ARCHIVE, id=appid)
+        entry.app.CopyFrom(self.get_scheduled().apps[index])
+        self.record(entry)
+        return True
+
+    def delete(self, appid):
+        self.record(PBJournalEntry(op=PBJournalEntry.DELETE, id=appid))
+
+    # called by save() while holding the lock
+    def run_save_hooks(self):
+        if not self.save_hooks:
+            return
+        scheduled = self.load()
+        for hook in self.save_hooks:
+            try:
+                hook(scheduled)
+            except Exception:
+                app.logger.exception("save hook failed")
+
+
+# The schedule is a snapshot file plus a journal of the mutations
+# since. Every mutation appends a small entry to the journal, readers
+# replay it on top of the snapshot. Once the journal grew large it is
+# folded into a new snapshot in the background.
+#
+# The archive is split into one segment file per year plus an index.
+# Archived pubs are added to their segment when the journal entry
+# removing them from the schedule is saved.
+#
+# All files are only ever replaced by rename, readers don't need locks
+# and never see partial files. Writers serialize on storage.lock.
+# Readers open the journal before the snapshot, so they never combine
+# an old snapshot with a journal that is already newer. Every journal
+# starts with a checkpoint entry carrying the version of the snapshot
+# it continues. The snapshot is only rewritten if the journal changed
+# it, otherwise it keeps its older version.
+class ProtobufStorage(StorageHelper):
+
+    def __init__(self):
+        StorageHelper.__init__(self)
+        # (journal id, offset, seq) of the last journal entry seen
+        self.journal_pos = (None, 0, 0)
+        self.compacting = False
+
+    # changes whenever any worker saved a mutation or compacted
+    def generation(self):
+        return tuple(self.snapshot_key(path) for path in
+                     (JOURNAL, SCHEDULE, ARCHIVE_INDEX, LEGACY_ARCHIVE,
+                      COMMENTS))
+
+    # journals are identified by inode and the seq of their checkpoint,
+    # inodes alone get reused once a journal has been replaced
+    def journal_id(self, f):
+        f.seek(0)
+        head = f.read(16)
+        for start, end in pbrecords.iter_delimited(head):
+            checkpoint = PBJournalEntry.FromString(head[start:end])
+            return (os.fstat(f.fileno()).st_ino, checkpoint.seq)
+        return None
+
+    # map a data file, returns its file key and the map, which is empty
+    # for an empty file. (None, '') if it doesn't exist. as files are
+    # only replaced by rename, a map stays valid while it is used.
+    def map_snapshot(self, path):
+        try:
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                data = b''
+                if st.st_size:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             f.close()
+        except IOError:
+            return None, b''
+        return self.file_key(st), data
+
+    # parse a data file straight from the map, without a copy on the heap
+    def read_snapshot(self, path, message=PBAppointmentList):
+        apps = message()
+        key, data = self.map_snapshot(path)
+        if data:
+            apps.ParseFromString(data)
+            metrics.inc('nomaden_storage_parses_total')
+            metrics.inc('nomaden_storage_read_bytes_total', len(data))
+        return StoreState(key, apps, getattr(apps, 'version', 0))
+
+    # the pubs of a data file, decoded on access. with the offsets of
+    # its index only the pages of the pubs accessed are read. the files
+    # stay mapped while the list is cached.
+    def read_records(self, path):
+        key, data = self.map_snapshot(path)
+        index = self.map_snapshot(index_path(path))[1]
+        return StoreState(key, pbrecords.RecordList(data, 1, PBAppointment,
+                                                    index), 0)
+
+    def read_schedule(self):
+        state = self.read_snapshot(SCHEDULE)
+        state.apps = Schedule(state.apps.apps, state.apps.version)
+        return state
+
+    # apply the journal entries from offset on to state, the schedule
+    # is copied before the first change as it may be shared
+    def replay(self, state, journal, jid, offset):
+        journal.seek(offset)
+        data = journal.read()
+        metrics.inc('nomaden_storage_read_bytes_total', len(data))
+
+        apps = state.apps
+        seq = state.seq
+        end = 0
+        for start, end in pbrecords.iter_delimited(data):
+            entry = PBJournalEntry.FromString(data[start:end])
+            if entry.seq <= seq:
+                continue
+            seq = entry.seq
+            if entry.op == PBJournalEntry.CHECKPOINT:
+                continue
+            if apps is state.apps:
+                apps = state.apps.copy()
+            apply_to_schedule(apps, entry)
+
+        if self.journal_pos[0] != jid or self.journal_pos[1] < offset + end:
+            self.journal_pos = (jid, offset + end, seq)
+
+        return StoreState(state.key, apps, seq, jid, offset + end,
+                          state.dirty or apps is not state.apps)
+
+    # return the current schedule. the list is shared by all requests
+    # and must not be modified.
+    def load(self):
+        metrics.inc('nomaden_storage_loads_total')
+        try:
+            journal = open(JOURNAL, "rb")
+        except IOError:
+            journal = None
+
+        try:
+            state = self.cache.get(SCHEDULE)
+            if state is None or state.key != self.snapshot_key(SCHEDULE):
+                state = self.read_schedule()
+
+            if journal:
+                jid = self.journal_id(journal)
+                size = os.fstat(journal.fileno()).st_size
+                offset = state.offset if state.journal == jid else 0
+                if offset < size:
+                    state = self.replay(state, journal, jid, offset)
+        finally:
+            if journal:
+                journal.close()
+
+        self.cache[SCHEDULE] = state
+        return state.apps
+
+    # return the content of a file that is not journaled, shared like
+    # the schedule
+    def load_file(self, path, message=PBAppointmentList):
+        state = self.cache.get(path)
+        if state is None or state.key != self.snapshot_key(path):
+            state = self.read_snapshot(path, message)
+            self.cache[path] = state
+        return state.apps
+
+    # like load_file, the pubs of a file decoded on access
+    def load_records(self, path):
+        state = self.cache.get(path)
+        if state is None or state.key != self.snapshot_key(path):
+            state = self.read_records(path)
+            self.cache[path] = state
+        return state.apps
+
+    def get_archive_index(self):
+        if os.path.exists(LEGACY_ARCHIVE):
+            self.migrate_archive()
+        return self.load_file(ARCHIVE_INDEX, PBArchiveIndex)
+
+    # the archived pubs of a year, newest first, only those accessed
+    # get decoded
+    def get_archived(self, year):
+        return self.load_records(segment_path(year))
+
+    # seq and offset of the last complete entry of an open journal, a
+    # partial entry left behind by a crashed writer gets cut off
+    def journal_end(self, f):
+        size = os.fstat(f.fileno()).st_size
+        jid, offset, seq = self.journal_pos
+        if jid != self.journal_id(f) or offset > size:
+            offset, seq = 0, 0
+
+        f.seek(offset)
+        data = f.read()
+        end = 0
+        for start, end in pbrecords.iter_delimited(data):
+            seq = PBJournalEntry.FromString(data[start:end]).seq
+
+        if offset + end < size:
+            f.truncate(offset + end)
+        return seq, offset + end
+
+    # add pubs to their archive segments, pubs already in there are
+    # skipped so this can be repeated after a crash. only called while
+    # holding the storage lock.
+    def append_archive(self, pbapps):
+        records = [pbapp.SerializeToString() for pbapp in pbapps]
+        years = {}
+        for idx, pbapp in enumerate(pbapps):
+            years.setdefault(archive_year(pbapp), []).append(
+                (pbapp.setdate, pbapp.id, records.__getitem__, idx))
+        self.merge_archive(years)
+
+    # merge pubs into the archive segments, years maps the year to
+    # (setdate, id, record, idx) of its pubs, record(idx) being the
+    # serialized pub. only these keys are sorted, the segments are
+    # written a pub at a time, the pubs already in there are copied
+    # from the map of the segment.
+    def merge_archive(self, years):
+        index = self.read_snapshot(ARCHIVE_INDEX, PBArchiveIndex).apps
+        segments = dict((seg.year, seg) for seg in index.segments)
+
+        for year, added in years.items():
+            path = segment_path(year)
+            segment = self.read_records(path).apps
+            keys = []
+            ids = set()
+            for idx, pbapp in enumerate(segment):
+                keys.append((pbapp.setdate, segment.record, idx))
+                if pbapp.id != '':
+                    ids.add(pbapp.id)
+            count = len(keys)
+            keys.extend((setdate, record, idx)
+                        for setdate, appid, record, idx in added
+                        if appid == '' or appid not in ids)
+            if len(keys) == count:
+                continue
+
+            keys.sort(key=lambda x: x[0], reverse=True)
+            with atomic_file(path) as f:
+                writer = pbrecords.RecordWriter(f, 1)
+                for setdate, record, idx in keys:
+                    writer.write(record(idx))
+            # readers check that the index belongs to the segment
+            write_atomic(index_path(path), writer.index())
+
+            seg = segments.get(year)
+            if seg is None:
+                seg = PBArchiveIndex.Segment(year=year)
+            seg.count = len(keys)
+            seg.first = keys[-1][0]
+            seg.last = keys[0][0]
+            segments[year] = seg
+
+        index = PBArchiveIndex()
+        index.segments.extend(sorted(segments.values(),
+                                     key=lambda seg: seg.year, reverse=True))
+        write_atomic(ARCHIVE_INDEX, index.SerializeToString())
+
+    # split archive.pb, as written by older versions or import-old.py,
+    # into the year segments. the pubs are copied from the map of the
+    # file, so a large import is never held in memory as a whole.
+    def migrate_archive(self):
+        with self.exclusive():
+            key, data = self.map_snapshot(LEGACY_ARCHIVE)
+            if key is None:
+                # another worker was faster
+                return
+
+            legacy = pbrecords.RecordList(data, 1, PBAppointment)
+            years = {}
+            for idx, pbapp in enumerate(legacy):
+                years.setdefault(archive_year(pbapp), []).append(
+                    (pbapp.setdate, pbapp.id, legacy.record, idx))
+
+            # archived pubs not yet folded into archive.pb
+            version = pbrecords.varint_field(data, 2)
+            journaled = []
+            try:
+                with open(JOURNAL, "rb") as f:
+                    for record in pbrecords.read_delimited(f):
+                        entry = PBJournalEntry.FromString(record)
+                        if entry.op == PBJournalEntry.ARCHIVE and\
+                           entry.seq > version:
+                            pbapp = entry.app
+                            years.setdefault(archive_year(pbapp), []).append(
+                                (pbapp.setdate, pbapp.id,
+                                 journaled.__getitem__, len(journaled)))
+                            journaled.append(pbapp.SerializeToString())
+                f.close()
+            except IOError:
+                pass
+
+            self.merge_archive(years)
+            os.rename(LEGACY_ARCHIVE, LEGACY_ARCHIVE + ".bak")
+
+        app.logger.info('archive split into segments count=%d',
+                        len(legacy) + len(journaled))
+
+    # move the comments older versions kept in the pubs to the comment
+    # log and write the schedule without them. the log is written first,
+    # a crash in between shows comments twice instead of losing them.
+    def migrate_comments(self):
+        with self.exclusive():
+            if os.path.exists(COMMENTS):
+                # another worker was faster
+                return
+
+            state = self.read_schedule()
+            try:
+                with open(JOURNAL, "rb") as journal:
+                    state = self.replay(state, journal,
+                                        self.journal_id(journal), 0)
+                journal.close()
+            except IOError:
+                pass
+
+            schedule = state.apps.copy()
+            data = []
+            for idx, pbapp in enumerate(schedule.apps):
+                if not pbapp.comments:
+                    continue
+                for com in pbapp.comments:
+                    record = PBCommentRecord(id=pbapp.id)
+                    record.comment.CopyFrom(com)
+                    data.append(pbrecords.delimited(record))
+                del schedule.mutable(idx).comments[:]
+
+            write_atomic(COMMENTS, b''.join(data))
+            if data:
+                # journal entries up to seq are skipped from now on
+                schedule.version = state.seq
+                write_atomic(SCHEDULE,
+                             schedule.to_message().SerializeToString())
+
+        app.logger.info('comments moved to the comment log count=%d',
+                        len(data))
+
+    # another worker saved since this request loaded the schedule, apply
+    # the pending entries to the current schedule again. entries that no
+    # longer apply are dropped, archived pubs are taken from the current
+    # schedule so that changes made meanwhile go along.
+    def rebase(self, pending):
+        schedule = self.load().copy()
+        rebased = []
+        for entry in pending:
+            if entry.op not in (PBJournalEntry.ENTER, PBJournalEntry.REORDER):
+                index = schedule.find(entry.id)
+                if index is None or\
+                   (entry.op == PBJournalEntry.MOVE and
+                        not 0 <= index + entry.delta < len(schedule.apps)):
+                    app.logger.info('dropping %s of %s, changed meanwhile',
+                                    PBJournalEntry.Op.Name(entry.op), entry.id)
+                    continue
+                if entry.op == PBJournalEntry.ARCHIVE:
+                    entry.app.CopyFrom(schedule.apps[index])
+            apply_to_schedule(schedule, entry)
+            rebased.append(entry)
+
+        flask_g.scheduled_apps = schedule
+        return rebased
+
+    # append the mutations of this request to the journal. the journal
+    # is compared to the version the request loaded, on a conflict the
+    # mutations are rebased first. both happen under the lock, so there
+    # is nothing to retry.
+    def save(self):
+        pending = getattr(flask_g, 'journal_pending', None)
+        if not pending:
+            return
 
-        archived = getattr(flask_g, 'archived_apps', None)
-        if archived:
-            with open("archive.pb", "wb") as f:
-                fcntl.lockf(f, fcntl.LOCK_EX)
-                f.write(archived.SerializeToString())
+        with self.exclusive():
+            with open(JOURNAL, "a+b") as f:
+                seq, offset = self.journal_end(f)
+
+                data = []
+                if offset == 0:
+                    # a fresh journal continues after the snapshot
+                    seq = self.read_snapshot(SCHEDULE).seq
+                    data.append(pbrecords.delimited(PBJournalEntry(
+                        op=PBJournalEntry.CHECKPOINT, seq=seq)))
+
+                if seq != getattr(flask_g, 'loaded_seq', None):
+                    pending = self.rebase(pending)
+
+                archived = [entry.app for entry in pending
+                            if entry.op == PBJournalEntry.ARCHIVE]
+                if archived:
+                    self.append_archive(archived)
+
+                for entry in pending:
+                    seq += 1
+                    entry.seq = seq
+                    data.append(pbrecords.delimited(entry))
+
+                data = b''.join(data)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                size = os.fstat(f.fileno()).st_size
+            metrics.inc('nomaden_storage_saves_total')
+            metrics.inc('nomaden_storage_written_bytes_total', len(data))
             f.close()
+            flask_g.loaded_seq = seq
+
+            self.run_save_hooks()
+
+        flask_g.journal_pending = []
+
+        if size > COMPACT_BYTES and not self.compacting:
+            self.compacting = True
+            compaction = threading.Thread(target=self.compact)
+            compaction.daemon = True
+            compaction.start()
+
+    # fold the journal into a new snapshot and start over with a journal
+    # that only holds a checkpoint
+    def compact(self):
+        try:
+            with self.exclusive():
+                self.fold_journal()
+        finally:
+            self.compacting = False
+
+    def fold_journal(self):
+        try:
+            journal = open(JOURNAL, "rb")
+        except IOError:
+            return
+        if os.fstat(journal.fileno()).st_size <= COMPACT_BYTES:
+            # another worker was faster
+            journal.close()
+            return
 
+        jid = self.journal_id(journal)
+        state = self.replay(self.read_schedule(), journal, jid, 0)
+        journal.close()
+
+        if state.dirty:
+            state.apps.version = state.seq
+            write_atomic(SCHEDULE, state.apps.to_message().SerializeToString())
+
+        checkpoint = PBJournalEntry(op=PBJournalEntry.CHECKPOINT,
+                                    seq=state.seq)
+        write_atomic(JOURNAL, pbrecords.delimited(checkpoint))
+
+        app.logger.info('journal compacted version=%d written=%s',
+                        state.seq, state.dirty)
+
+    def exists(self):
+        return any(os.path.exists(path) for path in
+                   (SCHEDULE, JOURNAL, ARCHIVE_INDEX, LEGACY_ARCHIVE))
+
+    # the scheduled pubs in their order and all archived pubs
+    def dump(self):
+        self.migrate_comments()
+        scheduled = list(self.load().apps)
+        archived = []
+        for seg in self.get_archive_index().segments:
+            archived.extend(self.get_archived(seg.year))
+        return scheduled, archived
+
+    # store pubs as returned by dump(), only into an empty directory
+    def restore(self, scheduled, archived):
+        with self.exclusive():
+            apps = PBAppointmentList()
+            apps.apps.extend(scheduled)
+            write_atomic(SCHEDULE, apps.SerializeToString())
+            self.append_archive(archived)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pubs (
+    id TEXT NOT NULL,
+    -- order of the scheduled pubs, NULL once archived
+    position INTEGER,
+    setdate TEXT NOT NULL,
+    -- archive segment of archived pubs, NULL while scheduled
+    year INTEGER,
+    -- the serialized Appointment
+    app BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pubs_id ON pubs (id);
+CREATE INDEX IF NOT EXISTS pubs_position ON pubs (position);
+CREATE INDEX IF NOT EXISTS pubs_archive ON pubs (year, setdate);
+-- the entries of the last saves, workers replay them on the schedule
+-- they have instead of reading all rows again
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY,
+    entry BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('seq', 0);
+INSERT OR IGNORE INTO meta VALUES ('modified', 0);
+"""
+
+
+# The pubs as rows of a SQLite database in WAL mode, so readers in all
+# workers go on while one of them writes. A row holds the serialized
+# pub and the columns it is looked up by, the place of a scheduled pub
+# and the year of an archived one. save() applies the mutations of a
+# request row by row in one transaction, entries that no longer apply
+# are dropped like on a rebase. The applied entries are numbered by seq
+# and kept in the journal table for a while, workers replay them on
+# their schedule. Changes that aren't journaled leave a gap in the
+# seqs, workers read all rows again then.
+class SqliteStorage(StorageHelper):
+
+    def __init__(self, path=DATABASE):
+        StorageHelper.__init__(self)
+        self.path = path
+        # the connections of this process, one per thread
+        self.local = threading.local()
+        # seq the archive was read at, the index and year -> segment
+        self.archive_seq = None
+        self.archive_index = None
+        self.segments = {}
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        # transactions are started explicitly
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.executescript(SQLITE_SCHEMA)
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    # (seq, unix time) of the last save
+    def read_meta(self, conn):
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        return meta['seq'], meta['modified']
+
+    def write_meta(self, conn, seq):
+        conn.executemany('UPDATE meta SET value = ? WHERE key = ?',
+                         ((seq, 'seq'), (int(time.time()), 'modified')))
+
+    # the journal entries after seq up to last, None if some are gone
+    def journal_since(self, conn, seq, last):
+        rows = conn.execute('SELECT entry FROM journal WHERE seq > ? '
+                            'ORDER BY seq', (seq,)).fetchall()
+        if len(rows) != last - seq:
+            return None
+        return [PBJournalEntry.FromString(str(row[0])) for row in rows]
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    # changes whenever any worker saved, the first entry is shaped like
+    # a file key for last_modified()
+    def generation(self):
+        seq, modified = self.read_meta(self.connect())
+        return ((None, seq, modified), self.snapshot_key(COMMENTS))
+
+    def parse_rows(self, rows):
+        apps = []
+        size = 0
+        for row in rows:
+            data = str(row[0])
+            apps.append(PBAppointment.FromString(data))
+            size += len(data)
+        metrics.inc('nomaden_storage_read_bytes_total', size)
+        return apps
+
+    # return the current schedule, shared like the one of the protobuf
+    # storage
+    def load(self):
+        metrics.inc('nomaden_storage_loads_total')
+        conn = self.connect()
+        state = self.cache.get(SCHEDULE)
+
+        conn.execute('BEGIN')
+        try:
+            seq = self.read_meta(conn)[0]
+            if state is not None and state.seq != seq:
+                entries = self.journal_since(conn, state.seq, seq)
+                if entries is None:
+                    state = None
+                else:
+                    apps = state.apps.copy()
+                    for entry in entries:
+                        apply_to_schedule(apps, entry)
+                    apps.version = seq
+                    state = StoreState(None, apps, seq)
+
+            if state is None:
+                apps = self.parse_rows(conn.execute(
+                    'SELECT app FROM pubs WHERE position IS NOT NULL '
+                    'ORDER BY position'))
+                metrics.inc('nomaden_storage_parses_total')
+                state = StoreState(None, Schedule(apps, seq), seq)
+        finally:
+            conn.execute('COMMIT')
+
+        self.cache[SCHEDULE] = state
+        return state.apps
+
+    def insert(self, conn, pbapp, position=None, year=None):
+        conn.execute('INSERT INTO pubs (id, position, setdate, year, app) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     (pbapp.id, position, pbapp.setdate, year,
+                      buffer(pbapp.SerializeToString())))
+
+    # (id, position) of the waiting pubs in their order
+    def waiting_rows(self, conn):
+        return conn.execute(
+            "SELECT id, position FROM pubs WHERE position IS NOT NULL "
+            "AND setdate = '' ORDER BY position").fetchall()
+
+    def reorder_rows(self, conn, order):
+        rows = self.waiting_rows(conn)
+        ids = waiting_order([appid for appid, position in rows], order)
+        for (current, position), appid in zip(rows, ids):
+            if appid != current:
+                conn.execute('UPDATE pubs SET position = ? '
+                             'WHERE id = ? AND position IS NOT NULL',
+                             (position, appid))
+
+    # apply a journal entry to the rows, False if it no longer applies
+    def apply(self, conn, entry):
+        if entry.op == PBJournalEntry.ENTER:
+            end = conn.execute('SELECT MAX(position) FROM pubs').fetchone()[0]
+            self.insert(conn, entry.app, 0 if end is None else end + 1)
+            return True
+        if entry.op == PBJournalEntry.REORDER:
+            self.reorder_rows(conn, entry.order)
+            return True
+
+        row = conn.execute('SELECT rowid, position, app FROM pubs '
+                           'WHERE id = ? AND position IS NOT NULL',
+                           (entry.id,)).fetchone()
+        if row is None:
+            return False
+        rowid, position, data = row
+        pbapp = PBAppointment.FromString(str(data))
+
+        if entry.op == PBJournalEntry.UPDATE:
+            update_fields(pbapp, entry.app)
+            conn.execute('UPDATE pubs SET setdate = ?, app = ? '
+                         'WHERE rowid = ?',
+                         (pbapp.setdate, buffer(pbapp.SerializeToString()),
+                          rowid))
+        elif entry.op == PBJournalEntry.MOVE:
+            if entry.delta < 0:
+                other = conn.execute(
+                    'SELECT rowid, position FROM pubs WHERE position < ? '
+                    'ORDER BY position DESC LIMIT 1 OFFSET ?',
+                    (position, -entry.delta - 1)).fetchone()
+            else:
+                other = conn.execute(
+                    'SELECT rowid, position FROM pubs WHERE position > ? '
+                    'ORDER BY position LIMIT 1 OFFSET ?',
+                    (position, entry.delta - 1)).fetchone()
+            if other is None:
+                return False
+            conn.executemany('UPDATE pubs SET position = ? WHERE rowid = ?',
+                             ((other[1], rowid), (position, other[0])))
+        elif entry.op == PBJournalEntry.MOVE_TO:
+            if pbapp.setdate != '':
+                return False
+            order = [appid for appid, pos in self.waiting_rows(conn)]
+            order.remove(entry.id)
+            order.insert(entry.position, entry.id)
+            self.reorder_rows(conn, order)
+        elif entry.op == PBJournalEntry.ARCHIVE:
+            conn.execute('UPDATE pubs SET position = NULL, year = ? '
+                         'WHERE rowid = ?', (archive_year(pbapp), rowid))
+        elif entry.op == PBJournalEntry.DELETE:
+            conn.execute('DELETE FROM pubs WHERE rowid = ?', (rowid,))
+        return True
+
+    # write the mutations of this request. the storage lock is taken as
+    # well, so the save hooks don't run concurrently.
+    def save(self):
+        pending = getattr(flask_g, 'journal_pending', None)
+        if not pending:
+            return
+
+        with self.exclusive():
+            with self.transaction() as conn:
+                seq = last = self.read_meta(conn)[0]
+                for entry in pending:
+                    if not self.apply(conn, entry):
+                        app.logger.info('dropping %s of %s, changed meanwhile',
+                                        PBJournalEntry.Op.Name(entry.op),
+                                        entry.id)
+                        continue
+                    seq += 1
+                    entry.seq = seq
+                    conn.execute('INSERT INTO journal (seq, entry) '
+                                 'VALUES (?, ?)',
+                                 (seq, buffer(entry.SerializeToString())))
+
+                if seq != last:
+                    conn.execute('DELETE FROM journal WHERE seq <= ?',
+                                 (seq - SQLITE_JOURNAL_KEEP,))
+                    self.write_meta(conn, seq)
+            metrics.inc('nomaden_storage_saves_total')
+            self.run_save_hooks()
+
+        flask_g.journal_pending = []
+
+    # the archive is read again once a pub was archived
+    def check_archive(self):
+        conn = self.connect()
+        seq = self.read_meta(conn)[0]
+        if seq == self.archive_seq:
+            return
+
+        entries = None
+        if self.archive_seq is not None:
+            entries = self.journal_since(conn, self.archive_seq, seq)
+        if entries is None or\
+           any(entry.op == PBJournalEntry.ARCHIVE for entry in entries):
+            self.archive_index = None
+            self.segments = {}
+        self.archive_seq = seq
+
+    def get_archive_index(self):
+        self.check_archive()
+        if self.archive_index is None:
+            index = PBArchiveIndex()
+            for year, count, first, last in self.connect().execute(
+                    'SELECT year, COUNT(*), MIN(setdate), MAX(setdate) '
+                    'FROM pubs WHERE year IS NOT NULL '
+                    'GROUP BY year ORDER BY year DESC'):
+                index.segments.add(year=year, count=count,
+                                   first=first, last=last)
+            self.archive_index = index
+        return self.archive_index
+
+    # the archived pubs of a year, newest first
+    def get_archived(self, year):
+        self.check_archive()
+        segment = self.segments.get(year)
+        if segment is None:
+            segment = self.parse_rows(self.connect().execute(
+                'SELECT app FROM pubs WHERE year = ? '
+                'ORDER BY setdate DESC, rowid', (year,)))
+            self.segments[year] = segment
+        return segment
+
+    # move the comments of rows written from older protobuf files to the
+    # comment log, like the protobuf storage does
+    def migrate_comments(self):
+        with self.exclusive():
+            if os.path.exists(COMMENTS):
+                # another worker was faster
+                return
+
+            with self.transaction() as conn:
+                data = []
+                rows = conn.execute(
+                    'SELECT rowid, app FROM pubs WHERE position IS NOT NULL '
+                    'ORDER BY position').fetchall()
+                for rowid, blob in rows:
+                    pbapp = PBAppointment.FromString(str(blob))
+                    if not pbapp.comments:
+                        continue
+                    for com in pbapp.comments:
+                        record = PBCommentRecord(id=pbapp.id)
+                        record.comment.CopyFrom(com)
+                        data.append(pbrecords.delimited(record))
+                    del pbapp.comments[:]
+                    conn.execute('UPDATE pubs SET app = ? WHERE rowid = ?',
+                                 (buffer(pbapp.SerializeToString()), rowid))
+
+                write_atomic(COMMENTS, b''.join(data))
+                self.write_meta(conn, self.read_meta(conn)[0] + 1)
+
+        app.logger.info('comments moved to the comment log count=%d',
+                        len(data))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def dump(self):
+        self.migrate_comments()
+        scheduled = list(self.load().apps)
+        archived = self.parse_rows(self.connect().execute(
+            'SELECT app FROM pubs WHERE year IS NOT NULL '
+            'ORDER BY year DESC, setdate DESC, rowid'))
+        return scheduled, archived
+
+    def restore(self, scheduled, archived):
+        with self.exclusive():
+            with self.transaction() as conn:
+                for position, pbapp in enumerate(scheduled):
+                    self.insert(conn, pbapp, position)
+                for pbapp in archived:
+                    self.insert(conn, pbapp, year=archive_year(pbapp))
+                self.write_meta(conn, self.read_meta(conn)[0] + 1)
+
+
+STORAGE_BACKENDS = {
+    'pb': ProtobufStorage,
+    'sqlite': SqliteStorage,
+}
+
+
+# the backend is chosen in the storage section of the config
+def storage_backend():
+    if config.has_option('storage', 'backend'):
+        return config.get('storage', 'backend', 0)
+    return 'pb'
+
+
+storage_helper = STORAGE_BACKENDS[storage_backend()]()
+
+
+# Comments are kept apart from the schedule in a log of comment
+# records that is only ever appended to, so adding one doesn't rewrite
+# anything and loading the schedule doesn't read them. Every worker
+# indexes the offsets of the records by pub while following the log,
+# showing the latest comments of a pub reads only their records.
+class CommentStore():
+
+    def __init__(self, path):
+        self.path = path
+        # pub id -> [(start, end)] of its records, oldest first
+        self.index = {}
+        # inode of the indexed log and how far it has been indexed
+        self.inode = None
+        self.offset = 0
+        # the log opened by this process
+        self.file = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # index the records appended since the last call, the log is
+    # created from the comments in the schedule if there is none yet.
+    # views call it once before reading the comments of their pubs.
+    # must not be called while holding the storage lock.
+    def refresh(self):
+        if not os.path.exists(self.path):
+            storage_helper.migrate_comments()
+        with self.lock:
+            self.follow()
+
+    def follow(self):
+        st = os.stat(self.path)
+        if self.pid != os.getpid() or self.inode != st.st_ino:
+            # the file position is not shared with forked processes
+            self.file = open(self.path, "rb")
+            self.pid = os.getpid()
+            st = os.fstat(self.file.fileno())
+            if self.inode != st.st_ino:
+                self.index = {}
+                self.inode = st.st_ino
+                self.offset = 0
+
+        if st.st_size <= self.offset:
+            return
+        self.file.seek(self.offset)
+        data = self.file.read()
+        metrics.inc('nomaden_storage_read_bytes_total', len(data))
+
+        end = 0
+        for start, end in pbrecords.iter_delimited(data):
+            record = PBCommentRecord.FromString(data[start:end])
+            self.index.setdefault(record.id, []).append(
+                (self.offset + start, self.offset + end))
+        self.offset += end
+
+    # the index of this process as of the last refresh(), empty if
+    # there was none yet
+    def spans(self, appid):
+        if self.pid != os.getpid():
+            return []
+        return self.index.get(appid, [])
+
+    def count(self, appid):
+        return len(self.spans(appid))
+
+    # the latest count comments of a pub, oldest first, all of them if
+    # count is None
+    def latest(self, appid, count=None):
+        with self.lock:
+            spans = self.spans(appid)
+            if count is not None:
+                spans = spans[-count:] if count else []
+
+            comments = []
+            for start, end in spans:
+                self.file.seek(start)
+                record = PBCommentRecord.FromString(
+                    self.file.read(end - start))
+                comments.append(record.comment)
+        return comments
+
+    # append a comment to the log, a partial record left behind by a
+    # crashed writer gets cut off first
+    def append(self, appid, com):
+        record = PBCommentRecord(id=appid)
+        record.comment.CopyFrom(com)
+        data = pbrecords.delimited(record)
+
+        self.refresh()
+        with storage_helper.exclusive():
+            with self.lock:
+                self.follow()
+                with open(self.path, "r+b") as f:
+                    f.truncate(self.offset)
+                    f.seek(self.offset)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                f.close()
+        metrics.inc('nomaden_storage_saves_total')
+        metrics.inc('nomaden_storage_written_bytes_total', len(data))
+
+
+comment_store = CommentStore(COMMENTS)
+
+
+# decode a stored date, they are iso dates as written by put() or iso
+# datetimes as written by import-old.py, anything else goes to dateutil
+def parse_date(value):
+    if len(value) >= 10 and value[4] == '-' and value[7] == '-' and\
+       (len(value) == 10 or value[10] == 'T'):
+        try:
+            return datetime.date(int(value[:4]), int(value[5:7]),
+                                 int(value[8:10]))
+        except ValueError:
+            pass
+
+    import dateutil.parser
+    return dateutil.parser.parse(value).date()
+
+
+# marks a date of an Appointment that has not been decoded yet
+NOT_DECODED = object()
 
-storage_helper = StorageHelper()
 
+# a field of the underlying protobuf appointment, assigning it only
+# changes the Appointment until put() is called
+def pb_field(name):
+    def get(self):
+        if self.changes is not None and name in self.changes:
+            return self.changes[name]
+        return getattr(self.pbapp, name)
 
-class Appointment():
+    def set(self, value):
+        if self.changes is None:
+            self.changes = {}
+        self.changes[name] = value
 
-    entered = None
-    setdate = None
-    removed = None
+    return property(get, set)
+
+
+# a date field, decoded on first access
+def date_field(name):
+    slot = '_' + name
+
+    def get(self):
+        value = getattr(self, slot)
+        if value is NOT_DECODED:
+            raw = getattr(self.pbapp, name)
+            value = parse_date(raw) if raw != '' else None
+            setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    return property(get, set)
+
+
+# view of a protobuf appointment, fields are read from it on access
+class Appointment(object):
+
+    __slots__ = ('pbapp', 'sortorder', 'first', 'last', 'shown', 'changes',
+                 '_entered', '_setdate', '_removed')
+
+    name = pb_field('name')
+    street = pb_field('street')
+    city = pb_field('city')
+    publictrans = pb_field('publictrans')
+    source = pb_field('source')
+
+    entered = date_field('entered')
+    setdate = date_field('setdate')
+    removed = date_field('removed')
 
     def __init__(self, pbapp, index):
         self.sortorder = index + 1
         self.pbapp = pbapp
 
-        self.id = self.pbapp.id
-        self.name = self.pbapp.name
-        self.street = self.pbapp.street
-        self.city = self.pbapp.city
-        self.publictrans = self.pbapp.publictrans
-        self.source = self.pbapp.source
+        # position on the waiting list, set by get_waiting()
+        self.first = False
+        self.last = False
 
-        if self.pbapp.entered != '':
-            self.entered = dateutil.parser.parse(self.pbapp.entered).date()
+        # number of comments shown, None for all of them
+        self.shown = COMMENTS_SHOWN
 
-        if self.pbapp.setdate != '':
-            self.setdate = dateutil.parser.parse(self.pbapp.setdate).date()
+        self.changes = None
+        self._entered = NOT_DECODED
+        self._setdate = NOT_DECODED
+        self._removed = NOT_DECODED
 
-        if self.pbapp.removed != '':
-            self.removed = dateutil.parser.parse(self.pbapp.removed).date()
+    @property
+    def id(self):
+        return self.pbapp.id
+
+    # the latest comments, read from the comment log on access. the log
+    # is only followed by comment_store.refresh().
+    @property
+    def comments(self):
+        return comment_store.latest(self.id, self.shown)
 
-        self.comments = self.pbapp.comments
+    @property
+    def comment_count(self):
+        return comment_store.count(self.id)
 
     # return a url safe id
     def get_id(self):
         return self.pbapp.id
 
     def put(self, save=True):
-        self.pbapp.name = self.name
-        self.pbapp.street = self.street
-        self.pbapp.city = self.city
-        self.pbapp.publictrans = self.publictrans
-        self.pbapp.source = self.source
+        start = time.time()
+        pbapp = PBAppointment()
+        pbapp.name = self.name
+        pbapp.street = self.street
+        pbapp.city = self.city
+        pbapp.publictrans = self.publictrans
+        pbapp.source = self.source
 
         if self.entered:
-            self.pbapp.entered = self.entered.isoformat()
+            pbapp.entered = self.entered.isoformat()
         if self.setdate:
-            self.pbapp.setdate = self.setdate.isoformat()
+            pbapp.setdate = self.setdate.isoformat()
         if self.removed:
-            self.pbapp.removed = self.removed.isoformat()
+            pbapp.removed = self.removed.isoformat()
 
-        self.pbapp.id = self.id
+        pbapp.id = self.id
 
-        app.logger.info('putting {}'.format(self.pbapp))
+        storage_helper.put(pbapp)
         if save:
             storage_helper.save()
+        log_op('put', self.id, start, saved=save)
+
+    def add_comment(self, com):
+        start = time.time()
+        comment_store.append(self.id, com)
+        log_op('comment', self.id, start)
 
     # fetch an appointment by a url safe id
     @classmethod
     def by_id(cls, appid):
-        pbapps = storage_helper.get_scheduled()
-        for pbapp in pbapps.apps:
-            if pbapp.id == appid:
-                return Appointment(pbapp, 0)
+        sched = storage_helper.get_scheduled()
+        index = sched.find(appid)
+        if index is not None:
+            return Appointment(sched.apps[index], index)
 
     # get currently scheduled pubs
     @classmethod
@@ -173,14 +1581,39 @@ class Appointment():
     # get waiting list
     @classmethod
     def get_waiting(cls):
-        return [Appointment(x, idx) for idx, x in enumerate(storage_helper.get_scheduled().apps)
+        apps = [Appointment(x, idx) for idx, x in enumerate(storage_helper.get_scheduled().apps)
                 if x.setdate == '']
-
-    # get archived appointments
+        if apps:
+            apps[0].first = True
+            apps[-1].last = True
+        return apps
+
+    # get a page of archived appointments, newest first, optionally only
+    # those of one year. only the segments covering the page are read.
+    # returns the appointments and the number of archived appointments.
     @classmethod
-    def get_archive(cls):
-        return sorted([Appointment(x, idx) for idx, x in enumerate(storage_helper.get_archived().apps)], key=lambda appo: appo.setdate, reverse=True)
-
+    def get_archive(cls, year=None, page=1):
+        segments = [seg for seg in storage_helper.get_archive_index().segments
+                    if year is None or seg.year == year]
+
+        result = []
+        skip = (page - 1) * ARCHIVE_PAGE
+        for seg in segments:
+            if len(result) >= ARCHIVE_PAGE:
+                break
+            if skip >= seg.count:
+                skip -= seg.count
+                continue
+
+            pbapps = storage_helper.get_archived(seg.year)
+            end = skip + ARCHIVE_PAGE - len(result)
+            result.extend(Appointment(x, idx) for idx, x in
+                          enumerate(pbapps[skip:end], skip))
+            skip = 0
+
+        return result, sum(seg.count for seg in segments)
+
+    # a new pub, it gets stored on put()
     @classmethod
     def append_pub(cls):
         sched = storage_helper.get_scheduled()
@@ -188,82 +1621,91 @@ class Appointment():
         pbapp = PBAppointment()
 
         pbapp.id = str(uuid())
-        sched.apps.extend([pbapp])
 
-        return Appointment(sched.apps[-1], len(sched.apps))
+        return Appointment(pbapp, len(sched.apps))
 
     def __eq__(self, other): 
         return self.id == other.id
 
     # archive this appointment
     def archive(self):
-        sched = storage_helper.get_scheduled()
-        archi = storage_helper.get_archived()
-
-        if self.pbapp in sched.apps:
-            sched.apps.remove(self.pbapp)
-            pbapp = PBAppointment()
-            pbapp.CopyFrom(self.pbapp)
-            archi.apps.extend([pbapp])
-
+        start = time.time()
+        if storage_helper.archive(self.id):
             storage_helper.save()
+            log_op('archive', self.id, start)
 
     def delete(self):
-        sched = storage_helper.get_scheduled()
-        sched.apps.remove(self.pbapp)
+        start = time.time()
+        storage_helper.delete(self.id)
         storage_helper.save()
-        app.logger.info("pub deleted key={}".format(self.id))
+        log_op('delete', self.id, start)
 
     def move_forward(self):
         if self.setdate is not None:
-            app.logger.info('cannot move direction=forward id={}'.format(self.id))
+            app.logger.info('cannot move direction=forward id=%s', self.id)
             return
-        sched = storage_helper.get_scheduled()
-        for idx, item in enumerate(sched.apps):
-            if item.id == self.id:
-                index = idx
+        start = time.time()
+        index = storage_helper.find(self.id)
 
         if index > 0:
-            tmp = PBAppointment()
-            tmp.CopyFrom(sched.apps[index-1])
-            sched.apps[index-1].CopyFrom(self.pbapp)
-            sched.apps[index].CopyFrom(tmp)
-
-            app.logger.info('pub moved direction=forward id={}'.format(self.id))
-
+            storage_helper.move(self.id, -1)
             storage_helper.save()
+            log_op('move', self.id, start, direction='forward')
         else:
-            app.logger.info('already first move direction=forward id={}'.format(self.id))
+            app.logger.info('already first move direction=forward id=%s', self.id)
 
     def move_backward(self):
         if self.setdate is not None:
-            app.logger.info('cannot move direction=backward id={}'.format(self.id))
+            app.logger.info('cannot move direction=backward id=%s', self.id)
             return
+        start = time.time()
         sched = storage_helper.get_scheduled()
-        for idx, item in enumerate(sched.apps):
-            if item.id == self.id:
-                index = idx
+        index = storage_helper.find(self.id)
 
         if index + 1 < len(sched.apps):
-            app.logger.info("exchanging {} for {}".format(sched.apps[index], sched.apps[index+1]))
-            tmp = PBAppointment()
-            tmp.CopyFrom(sched.apps[index+1])
-            sched.apps[index+1].CopyFrom(sched.apps[index])
-            sched.apps[index].CopyFrom(tmp)
+            storage_helper.move(self.id, 1)
+            storage_helper.save()
+            log_op('move', self.id, start, direction='backward',
+                   other=sched.apps[index + 1].id)
+        else:
+            app.logger.info('already last move direction=backward id=%s', self.id)
 
-            app.logger.info('pub moved direction=backward id={}'.format(self.id))
+    # move to position on the waiting list, counted from 0. fixed pubs
+    # stay where they are.
+    def move_to(self, position):
+        if self.setdate is not None:
+            app.logger.info('cannot move direction=to id=%s', self.id)
+            return
+        start = time.time()
+        last = len(storage_helper.get_scheduled().waiting_ids()) - 1
+        position = max(0, min(position, last))
 
+        if storage_helper.move_to(self.id, position):
             storage_helper.save()
-        else:
-            app.logger.info('already last move direction=backward id={}'.format(self.id))
+            log_op('move', self.id, start, direction='to', position=position)
+
+    # put the waiting list in the order of the given ids in one step. ids
+    # that are not on the waiting list raise a ParameterError, waiting
+    # pubs not mentioned follow in their current order.
+    @classmethod
+    def reorder(cls, order):
+        start = time.time()
+        waiting = set(storage_helper.get_scheduled().waiting_ids())
+        for appid in order:
+            if appid not in waiting:
+                raise ParameterError(appid)
+        if len(set(order)) != len(order):
+            raise ParameterError(order)
+
+        storage_helper.reorder(order)
+        storage_helper.save()
+        log_op('reorder', None, start, count=len(order))
 
     def is_first(self):
-        apps = Appointment.get_waiting()
-        return self.id == apps[0].id
+        return self.first
 
     def is_last(self):
-        apps = Appointment.get_waiting()
-        return self.id == apps[-1].id
+        return self.last
 
     def is_fix(self):
         return self.setdate is not None
@@ -301,6 +1743,14 @@ def previous_tuesday():
     return target
 
 
+# identifies the fields of the fixed pubs shown in the calendars and
+# the weekly mail
+def fixed_fingerprint(apps):
+    fields = [(appo.id, appo.name, appo.street, appo.city, appo.publictrans,
+               appo.pbapp.setdate) for appo in apps]
+    return sha1(repr(fields).encode('utf-8')).hexdigest()
+
+
 # get a source string for reproduceabiltiy purposes
 def generate_source(req):
     now = datetime.datetime.now().isoformat()
@@ -329,18 +1779,301 @@ class NewsEmail:
 
         return render_template('weekly.email', **template_values)
 
-    def send(self):
-        msg_body = self.build_body()
-        msg = MIMEText(msg_body)
+    # the html variant, None if there is no template for it
+    def build_html(self):
+        try:
+            return render_template('weekly-email.html', pubs=self.pubs)
+        except TemplateNotFound:
+            return None
+
+    # queue the mail, the outbox sends it in the background. body and
+    # html are utf-8, they are rendered if not given.
+    def send(self, body=None, html=None):
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
+        if body is None:
+            body = self.build_body().encode('utf-8')
+            html = self.build_html()
+            if html is not None:
+                html = html.encode('utf-8')
+
+        if html is None:
+            msg = MIMEText(body, 'plain', 'utf-8')
+        else:
+            msg = MIMEMultipart('alternative')
+            msg.attach(MIMEText(body, 'plain', 'utf-8'))
+            msg.attach(MIMEText(html, 'html', 'utf-8'))
         msg['Subject'] = self.subject
         msg['From'] = self.sender
         msg['To'] = ', '.join(self.recipients)
 
-        s = SMTP('localhost')
+        outbox.enqueue(self.sender, self.recipients, msg.as_string())
+
+
+# The weekly mail is rendered whenever the fixed pubs change and kept
+# in DIGEST_DIR, /publishMail only reads and queues it.
+DIGEST_DIR = "digest"
+
 
-        s.sendmail(self.sender,
-                   self.recipients,
-                   msg.as_string())
+# identifies the rendered mail, it changes with the pubs and templates
+def digest_fingerprint(apps):
+    sources = []
+    for name in ('weekly.email', 'weekly-email.html'):
+        try:
+            sources.append(app.jinja_env.loader.get_source(app.jinja_env,
+                                                           name)[0])
+        except TemplateNotFound:
+            sources.append(None)
+    return sha1(fixed_fingerprint(apps) +
+                repr(sources).encode('utf-8')).hexdigest()
+
+
+# render the weekly mail of the fixed pubs to DIGEST_DIR if they
+# changed. runs with the storage lock held, like write_calendars().
+def write_digest(scheduled):
+    apps = [Appointment(x, idx) for idx, x in enumerate(scheduled.apps)
+            if x.setdate != '']
+    fingerprint = digest_fingerprint(apps)
+    if fingerprint == read_file(os.path.join(DIGEST_DIR, "fingerprint")):
+        return
+
+    if not os.path.isdir(DIGEST_DIR):
+        os.makedirs(DIGEST_DIR)
+
+    msg = NewsEmail()
+    for appo in apps:
+        msg.add_pub(appo)
+    write_atomic(os.path.join(DIGEST_DIR, "weekly.txt"),
+                 msg.build_body().encode('utf-8'))
+
+    html = msg.build_html()
+    if html is not None:
+        write_atomic(os.path.join(DIGEST_DIR, "weekly.html"),
+                     html.encode('utf-8'))
+    elif os.path.exists(os.path.join(DIGEST_DIR, "weekly.html")):
+        os.remove(os.path.join(DIGEST_DIR, "weekly.html"))
+
+    write_atomic(os.path.join(DIGEST_DIR, "fingerprint"), fingerprint)
+    app.logger.info("wrote digest %s", fingerprint)
+
+
+# the rendered weekly mail as (text, html), html is None without a
+# template for it. rendered first if it is outdated.
+def read_digest():
+    apps = Appointment.get_current()
+    if digest_fingerprint(apps) != read_file(os.path.join(DIGEST_DIR,
+                                                          "fingerprint")):
+        with storage_helper.exclusive():
+            write_digest(storage_helper.load())
+
+    return (read_file(os.path.join(DIGEST_DIR, "weekly.txt")),
+            read_file(os.path.join(DIGEST_DIR, "weekly.html")))
+
+
+OUTBOX = "outbox"
+OUTBOX_LOCK = "outbox.lock"
+
+# recipients per smtp transaction
+MAIL_RCPT_BATCH = 50
+# seconds until a failed mail is tried again, doubled on every failure
+MAIL_RETRY = 60
+MAIL_RETRY_MAX = 3600
+# mails failing this often are moved to OUTBOX/failed
+MAIL_ATTEMPTS = 10
+
+
+def mail_server():
+    host = 'localhost'
+    port = 25
+    if config.has_option('mail', 'host'):
+        host = config.get('mail', 'host', 0)
+    if config.has_option('mail', 'port'):
+        port = config.getint('mail', 'port')
+    return host, port
+
+
+# Mails are written to OUTBOX and sent by a background thread, so
+# requests don't wait for the mail server. Workers take turns on
+# outbox.lock, the one holding it sends all due mails over a single
+# connection. Failed mails stay in the outbox and are tried again
+# later.
+class Outbox():
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        # the sender thread waits on it for the next retry, wake() cuts
+        # the wait short for a new mail
+        self.wakeup = threading.Condition(self.thread_lock)
+        # whether the sender thread runs and whether it has to look at
+        # the outbox again before it stops
+        self.sending = False
+        self.pending = False
+
+    def enqueue(self, sender, recipients, message):
+        mail = PBOutgoingMail(sender=sender, message=message)
+        mail.recipients.extend(recipients)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = "{:.6f}-{}.pb".format(time.time(), uuid())
+        write_atomic(os.path.join(self.path, name), mail.SerializeToString())
+        app.logger.info('mail queued name=%s recipients=%d', name,
+                        len(recipients))
+
+        self.wake()
+
+    # start the sender thread unless it is running already, a running
+    # one stops waiting for a retry
+    def wake(self):
+        with self.thread_lock:
+            self.pending = True
+            if self.sending:
+                self.wakeup.notify()
+                return
+            self.sending = True
+
+        sender = threading.Thread(target=self.run)
+        sender.daemon = True
+        sender.start()
+
+    # the queued mails in the order they were queued
+    def queued(self):
+        try:
+            names = sorted(name for name in os.listdir(self.path)
+                           if name.endswith(".pb"))
+        except OSError:
+            return []
+
+        mails = []
+        for name in names:
+            try:
+                with open(os.path.join(self.path, name), "rb") as f:
+                    mails.append((name, PBOutgoingMail.FromString(f.read())))
+                f.close()
+            except IOError:
+                # sent by another worker meanwhile
+                pass
+        return mails
+
+    def run(self):
+        try:
+            while True:
+                with self.thread_lock:
+                    self.pending = False
+
+                wait = self.send_due()
+                with self.thread_lock:
+                    if wait is not None:
+                        if not self.pending:
+                            self.wakeup.wait(wait)
+                        continue
+
+                    if not self.pending:
+                        self.sending = False
+                        return
+        except Exception:
+            app.logger.exception("mail sender failed")
+            with self.thread_lock:
+                self.sending = False
+
+    # send the mails that are due, returns the seconds until the next
+    # retry or None if the outbox is empty
+    def send_due(self):
+        start = time.time()
+        with open(OUTBOX_LOCK, "a") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            metrics.observe('nomaden_lock_wait_seconds', time.time() - start,
+                            'outbox')
+
+            mails = self.queued()
+            now = time.time()
+            due = [(name, mail) for name, mail in mails
+                   if mail.retry_at <= now]
+            if due:
+                self.send_batch(due)
+                return 0
+            if mails:
+                return max(1, min(mail.retry_at for name, mail in mails) - now)
+            return None
+
+    def send_batch(self, due):
+        from smtplib import SMTP, SMTPException, SMTPResponseException
+
+        try:
+            smtp = SMTP(*mail_server())
+        except (socket.error, SMTPException) as e:
+            for name, mail in due:
+                self.failed(name, mail, e)
+            return
+
+        try:
+            for name, mail in due:
+                try:
+                    self.send_mail(smtp, name, mail)
+                except SMTPResponseException as e:
+                    self.failed(name, mail, e, permanent=e.smtp_code >= 500)
+                except (socket.error, SMTPException) as e:
+                    # the connection is gone, the rest is tried again
+                    self.failed(name, mail, e)
+                    return
+        finally:
+            try:
+                smtp.quit()
+            except (socket.error, SMTPException):
+                smtp.close()
+
+    # send one mail, in transactions of MAIL_RCPT_BATCH recipients.
+    # recipients done are removed from the queued mail so a retry
+    # doesn't send to them twice.
+    def send_mail(self, smtp, name, mail):
+        from smtplib import SMTPRecipientsRefused
+
+        path = os.path.join(self.path, name)
+        while len(mail.recipients) > 0:
+            batch = list(mail.recipients[:MAIL_RCPT_BATCH])
+            try:
+                refused = smtp.sendmail(mail.sender, batch, mail.message)
+            except SMTPRecipientsRefused as e:
+                refused = e.recipients
+            for rcpt, error in refused.items():
+                app.logger.warning('mail refused name=%s to=%s error=%s',
+                                   name, rcpt, error)
+
+            del mail.recipients[:MAIL_RCPT_BATCH]
+            if len(mail.recipients) > 0:
+                write_atomic(path, mail.SerializeToString())
+
+        os.remove(path)
+        app.logger.info('mail sent name=%s', name)
+
+    def failed(self, name, mail, error, permanent=False):
+        path = os.path.join(self.path, name)
+        mail.attempts += 1
+        if permanent or mail.attempts >= MAIL_ATTEMPTS:
+            failed = os.path.join(self.path, "failed")
+            if not os.path.isdir(failed):
+                os.makedirs(failed)
+            os.rename(path, os.path.join(failed, name))
+            app.logger.error('mail failed name=%s error=%s', name, error)
+            return
+
+        delay = min(MAIL_RETRY * 2 ** (mail.attempts - 1), MAIL_RETRY_MAX)
+        mail.retry_at = int(time.time() + delay)
+        write_atomic(path, mail.SerializeToString())
+        app.logger.warning('mail retry name=%s in=%ds error=%s', name, delay,
+                           error)
+
+
+outbox = Outbox(OUTBOX)
+
+
+# mails left over by a previous run
+@app.before_first_request
+def start_outbox():
+    if outbox.queued():
+        outbox.wake()
 
 
 class ParameterError(Exception):
@@ -365,43 +2098,201 @@ class NomadicUser:
         self.is_anonymous = False
 
     def check_pw(self, pw):
-        check = pbkdf2_hmac(self.alg, pw,
+        start = time.time()
+        check = pbkdf2_hmac(self.alg, pw.encode('utf-8'),
                             self.salt, self.rounds)
-        return check == self.secret
+        metrics.observe('nomaden_pbkdf2_seconds', time.time() - start)
+        return compare_digest(check, self.secret)
 
     def get_id(self):
         return self.username
 
 
-userdict = {}
+USERS = "users.txt"
+
+# hashes with fewer rounds are replaced on the next successful login
+USER_ROUNDS = 100000
+
+
+# a line of users.txt is alg:salt:rounds:secret:username, as printed by
+# genkeys.py
+def parse_user(line):
+    alg, salt, rounds, secret, username = line.split(':')
+    return NomadicUser(alg, unhexlify(salt), int(rounds), unhexlify(secret),
+                       username.decode('utf-8'))
+
+
+def format_user(user):
+    return "{0}:{1}:{2}:{3}:{4}".format(user.alg, hexlify(user.salt),
+                                        user.rounds, hexlify(user.secret),
+                                        user.username.encode('utf-8'))
+
+
+# the users of users.txt. the file is checked on every lookup and read
+# again once it changed, users can be added without a restart. lines
+# that did not change keep their user.
+class UserStore():
+
+    def __init__(self, path):
+        self.path = path
+        # file key of the version read
+        self.key = None
+        # line -> NomadicUser
+        self.lines = {}
+        # username -> NomadicUser, replaced as a whole on reload
+        self.users = {}
+
+    def refresh(self):
+        key = storage_helper.snapshot_key(self.path)
+        if key == self.key:
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                content = f.read()
+            f.close()
+        except IOError:
+            content = b''
+
+        lines = {}
+        users = {}
+        for line in content.splitlines():
+            if not line:
+                continue
+            user = self.lines.get(line)
+            if user is None:
+                try:
+                    user = parse_user(line)
+                except (ValueError, TypeError):
+                    app.logger.warning('invalid line in %s', self.path)
+                    continue
+            lines[line] = user
+            users[user.username] = user
+
+        self.lines = lines
+        self.users = users
+        self.key = key
+        app.logger.info('users loaded count=%d', len(users))
+
+    def get(self, username):
+        self.refresh()
+        return self.users.get(username)
+
+    # hash the password of a user again with USER_ROUNDS. the line is
+    # only replaced if nobody changed it since it was read.
+    def rehash(self, user, pw):
+        salt = os.urandom(32)
+        start = time.time()
+        secret = pbkdf2_hmac(user.alg, pw.encode('utf-8'), salt, USER_ROUNDS)
+        metrics.observe('nomaden_pbkdf2_seconds', time.time() - start)
+        upgraded = NomadicUser(user.alg, salt, USER_ROUNDS, secret,
+                               user.username)
+
+        with storage_helper.exclusive():
+            with open(self.path, "rb") as f:
+                lines = f.read().splitlines()
+            f.close()
+
+            current = [x for x in lines if self.lines.get(x) is user]
+            if not current:
+                return
+            lines = [format_user(upgraded) if x == current[0] else x
+                     for x in lines]
+            write_atomic(self.path, b''.join(x + b'\n' for x in lines))
+
+        app.logger.info('password rehashed user=%s rounds=%d', user.username,
+                        USER_ROUNDS)
+
+
+user_store = UserStore(USERS)
+
+
+# Password checks are slow on purpose. Only LOGIN_SLOTS of them run at
+# the same time across all workers, and only one per username and per
+# client address, so a burst of logins can't tie up every worker. The
+# slots are byte ranges of LOGIN_LOCK, locked with lockf.
+LOGIN_LOCK = "login.lock"
+LOGIN_SLOTS = 1
+# seconds a login waits for a free slot
+LOGIN_WAIT = 1.0
+# byte ranges for the username and address locks
+LOGIN_KEYS = 4096
+
+# lockf locks are per process, threads of a worker take turns
+login_thread_lock = threading.Lock()
+
+
+class LoginBusy(Exception):
+    pass
+
 
+def try_lockf(f, offset):
+    try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+        return True
+    except IOError:
+        return False
 
-def load_users(aDict):
-    userfile = open('users.txt', 'r')
-    for line in userfile:
-        if len(line) > 0:
-            tmp = line[:-1]
-            alg, salt, rounds, secret, username = tmp.split(':')
-            username = username.decode('utf-8')
-            secret = unhexlify(secret)
-            salt = unhexlify(salt)
-            rounds = int(rounds)
-            aDict[username] = NomadicUser(alg, salt, rounds, secret, username)
 
+# lock one of the byte ranges in offsets, polling until deadline
+def wait_lockf(f, offsets, deadline):
+    while not any(try_lockf(f, offset) for offset in offsets):
+        if time.time() > deadline:
+            raise LoginBusy()
+        time.sleep(0.01)
 
-load_users(userdict)
+
+# wait for the turn of a password check, raises LoginBusy if the
+# username or address lock or a slot didn't get free in time
+@contextmanager
+def login_slot(uname, addr):
+    start = time.time()
+    deadline = start + LOGIN_WAIT
+    while not login_thread_lock.acquire(False):
+        if time.time() > deadline:
+            raise LoginBusy()
+        time.sleep(0.01)
+
+    try:
+        with open(LOGIN_LOCK, "a") as lock:
+            for key in (u'user:' + uname, u'addr:' + addr):
+                offset = crc32(key.encode('utf-8')) & 0xffffffff
+                wait_lockf(lock, [LOGIN_SLOTS + offset % LOGIN_KEYS],
+                           deadline)
+
+            wait_lockf(lock, range(LOGIN_SLOTS), deadline)
+            metrics.observe('nomaden_lock_wait_seconds',
+                            time.time() - start, 'login')
+
+            # closing the file releases the locks
+            yield
+    finally:
+        login_thread_lock.release()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    if user_id in userdict:
-        return userdict[user_id]
-    return None
+    return user_store.get(user_id)
 
 
 # http dispatching
 
 
+@app.before_request
+def start_timer():
+    flask_g.request_start = time.time()
+
+
+@app.after_request
+def record_time(response):
+    start = getattr(flask_g, 'request_start', None)
+    if start is not None:
+        metrics.observe('nomaden_request_seconds', time.time() - start,
+                        request.endpoint)
+    metrics.flush()
+    return response
+
+
 @app.after_request
 def set_headers(response):
     response.headers['Content-Security-Policy'] =\
@@ -415,6 +2306,116 @@ def set_headers(response):
     return response
 
 
+# rendered pages, (endpoint, user, args) -> (generation, page), the
+# least recently used first
+page_cache = collections.OrderedDict()
+page_cache_lock = threading.Lock()
+PAGE_CACHE_SIZE = 256
+
+
+# serve the page rendered by a view from page_cache until the stored
+# data changes. pages may only depend on the stored data, the user and
+# what page_args returns: the request args the view reads, normalized,
+# or None to render the page without caching it. so unknown args can't
+# fill the cache.
+def cached_page(page_args=lambda: ()):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            generation = storage_helper.generation()
+            page_key = page_args()
+            if page_key is None:
+                return view(*args, **kwargs)
+
+            user = None
+            if current_user.is_active:
+                user = current_user.get_id()
+            key = (request.endpoint, user, page_key)
+
+            with page_cache_lock:
+                cached = page_cache.pop(key, None)
+                if cached and cached[0] == generation:
+                    page_cache[key] = cached
+                    return cached[1]
+
+            page = view(*args, **kwargs)
+            with page_cache_lock:
+                while len(page_cache) >= PAGE_CACHE_SIZE:
+                    page_cache.popitem(last=False)
+                page_cache[key] = (generation, page)
+            return page
+        return wrapper
+    return decorator
+
+
+# the pub of the main page showing all its comments, pubs that are not
+# scheduled change nothing
+def main_page_args():
+    expanded = request.args.get('comments')
+    if expanded is not None and storage_helper.find(expanded) is None:
+        expanded = None
+    return (expanded,)
+
+
+# year and page of the archive, raises ParameterError if they are not
+# numbers
+def archive_params():
+    handler = NomadHandler()
+
+    year = request.args.get('year')
+    if year is not None:
+        year = handler.vrfy_posint(year)
+
+    page = handler.vrfy_posint(request.args.get('page', '1'))
+    if page < 1:
+        raise ParameterError(page)
+
+    return year, page
+
+
+# pages of years and beyond the end that don't exist aren't cached
+def archive_args():
+    year, page = archive_params()
+    segments = [seg for seg in storage_helper.get_archive_index().segments
+                if year is None or seg.year == year]
+    if year is not None and not segments:
+        return None
+    count = sum(seg.count for seg in segments)
+    if page > max(1, (count + ARCHIVE_PAGE - 1) // ARCHIVE_PAGE):
+        return None
+    return (year, page)
+
+
+# answer conditional GETs for views that only depend on the stored data
+# and the query string, the body is only built if the client's copy is
+# outdated
+def conditional_get(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = storage_helper.generation()
+        etag = sha1(repr((request.endpoint, request.query_string,
+                          generation))).hexdigest()
+        modified = storage_helper.last_modified(generation)
+
+        if request.if_none_match:
+            unchanged = request.if_none_match.contains(etag)
+        else:
+            unchanged = modified is not None and\
+                request.if_modified_since is not None and\
+                modified <= request.if_modified_since.replace(tzinfo=None)
+
+        if unchanged:
+            res = make_response('', 304)
+        else:
+            res = make_response(view(*args, **kwargs))
+
+        res.set_etag(etag)
+        res.last_modified = modified
+        res.cache_control.no_cache = True
+        return res
+    return wrapper
+
+
 class NomadHandler():
     posint_pat = re.compile(r'^[0-9]+$')
 
@@ -431,11 +2432,22 @@ def login():
         return render_template('login.html')
     else:
         uname = request.form.get('username')
-        pw = request.form.get('password')
+        pw = request.form.get('password', u'')
+
+        user = user_store.get(uname)
+        if user is not None:
+            addr = request.headers.get('X-Real-IP', request.remote_addr)
+            try:
+                with login_slot(uname, addr or u''):
+                    valid = user.check_pw(pw)
+                    if valid and user.rounds < USER_ROUNDS:
+                        user_store.rehash(user, pw)
+            except LoginBusy:
+                app.logger.info('login refused, busy user=%s', uname)
+                return render_template('login.html',
+                                       msg='Too many logins, try again later'), 429
 
-        if uname in userdict:
-            user = userdict[uname]
-            if user.check_pw(pw):
+            if valid:
                 login_user(user)
                 return redirect(url_for('main_page'))
             else:
@@ -454,11 +2466,20 @@ def logout():
 
 @app.route('/index', methods=['GET'])
 @app.route('/', methods=['GET'])
+@cached_page(main_page_args)
 def main_page():
+    comment_store.refresh()
+
     fixed_list = Appointment.get_current()
 
     wait_list = Appointment.get_waiting()
 
+    # all comments of one pub, the others show the latest
+    expanded = request.args.get('comments')
+    for appo in fixed_list + wait_list:
+        if appo.id == expanded:
+            appo.shown = None
+
     current_username = "not logged in"
     if current_user.is_active:
         current_username = current_user.get_id()
@@ -484,15 +2505,28 @@ def application_error(e):
     """Return a custom 500 error."""
     return 'Sorry, unexpected error: {}'.format(e), 500
 
+@app.errorhandler(ParameterError)
+def parameter_error(e):
+    return str(e), 400
+
 @app.route('/about', methods=['GET'])
 def about():
     return render_template('about.html')
 
 @app.route('/archive', methods=['GET'])
+@conditional_get
+@cached_page(archive_args)
 def archive():
-    archive_list = Appointment.get_archive()
+    year, page = archive_params()
+
+    archive_list, count = Appointment.get_archive(year, page)
 
-    template_values = {'archive_apps': archive_list}
+    template_values = {
+        'archive_apps': archive_list,
+        'years': [seg.year for seg in storage_helper.get_archive_index().segments],
+        'year': year,
+        'page': page,
+        'pages': (count + ARCHIVE_PAGE - 1) // ARCHIVE_PAGE, }
 
     return render_template('archive.html', **template_values)
 
@@ -539,11 +2573,9 @@ def comment():
 
         com.source = generate_source(request)
 
-        appo.comments.extend([com])
+        appo.add_comment(com)
 
-        appo.put()
-
-        app.logger.info('comment entered on pub id={}'.format(appid))
+        app.logger.info('comment entered on pub id=%s', appid)
 
     return redirect(url_for('main_page'))
 
@@ -558,7 +2590,13 @@ def move_pub():
     if 'direction' in request.args:
         direction = request.args['direction']
 
-    if direction == "forward":
+    if 'to' in request.args:
+        # position on the waiting list, the first pub is 1
+        position = NomadHandler().vrfy_posint(request.args['to'])
+        if position < 1:
+            raise ParameterError(position)
+        app.move_to(position - 1)
+    elif direction == "forward":
         app.move_forward()
     else:
         app.move_backward()
@@ -566,6 +2604,20 @@ def move_pub():
     return redirect(url_for('main_page'))
 
 
+# reorder the waiting list in one request, the ids of the pubs are
+# posted as id in their new order
+@app.route('/reorder', methods=['POST'])
+@login_required
+def reorder():
+    order = request.form.getlist('id')
+    if not order:
+        raise ParameterError(order)
+
+    Appointment.reorder(order)
+
+    return redirect(url_for('main_page'))
+
+
 @app.route('/delete', methods=['GET'])
 @login_required
 def delete():
@@ -583,19 +2635,48 @@ def delete():
 def publish_mail():
     if current_user.is_authenticated or\
        request.args.get('token') == config.get('app', 'crontoken', 0):
-        current_list = Appointment.get_current()
+        body, html = read_digest()
 
         msg = NewsEmail()
-        for appo in current_list:
-            msg.add_pub(appo)
-        msg.send()
+        msg.send(body, html)
     else:
         app.logger.info("unauthorized publishMail")  
 
     return redirect(url_for('main_page'))
 
 
+# the weekly mail as /publishMail would send it, ?html=1 for the html
+# variant
+@app.route('/previewMail', methods=['GET'])
+@login_required
+def preview_mail():
+    body, html = read_digest()
+
+    if request.args.get('html'):
+        if html is None:
+            return make_response('No html variant', 404)
+        res = make_response(html)
+        res.headers['Content-Type'] = 'text/html; charset=utf-8'
+    else:
+        res = make_response(body)
+        res.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    return res
+
+
+# counters and timings of all workers in the prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    if request.args.get('token') != config.get('app', 'crontoken', 0):
+        app.logger.info("unauthorized metrics")
+        return make_response('Forbidden', 403)
+
+    res = make_response(metrics.export())
+    res.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return res
+
+
 @app.route('/poster', methods=['GET'])
+@cached_page()
 def poster():
     current_list = Appointment.get_current()
 
@@ -605,6 +2686,9 @@ def poster():
     return render_template('poster.html', **template_values)
 
 def get_event(appo):
+    from ics import Event
+    import pytz
+
     e = Event()
 
     tz = pytz.timezone('Europe/Berlin')
@@ -619,39 +2703,97 @@ def get_event(appo):
 
     return e
 
+def calendar_data(apps):
+    from ics import Calendar
+
+    c = Calendar()
+    for appo in apps:
+        c.events.append(get_event(appo))
+    return str(c)
+
+
+def ics_entry_name(appid):
+    return "entry-{}.ics".format(appid)
+
+
+# write the feed and one calendar per fixed pub to ICS_DIR if the fixed
+# pubs changed. runs with the storage lock held, so the files always
+# follow the latest save.
+def write_calendars(scheduled):
+    apps = [Appointment(x, idx) for idx, x in enumerate(scheduled.apps)
+            if x.setdate != '']
+    fingerprint = fixed_fingerprint(apps)
+    if fingerprint == read_file(os.path.join(ICS_DIR, "fingerprint")):
+        return
+
+    if not os.path.isdir(ICS_DIR):
+        os.makedirs(ICS_DIR)
+
+    names = set()
+    for appo in apps:
+        names.add(ics_entry_name(appo.id))
+        write_atomic(os.path.join(ICS_DIR, ics_entry_name(appo.id)),
+                     calendar_data([appo]))
+    write_atomic(os.path.join(ICS_DIR, ICS_FEED), calendar_data(apps))
+
+    for name in os.listdir(ICS_DIR):
+        if name.startswith("entry-") and name not in names:
+            os.remove(os.path.join(ICS_DIR, name))
+
+    write_atomic(os.path.join(ICS_DIR, "fingerprint"), fingerprint)
+    app.logger.info("wrote calendars %s", fingerprint)
+
+
+# the files written after every save, whichever storage is used
+def add_save_hooks(helper):
+    helper.save_hooks.append(write_calendars)
+    helper.save_hooks.append(write_digest)
+
+
+add_save_hooks(storage_helper)
+
+
+# the written calendar file, brought up to date first if it was
+# written before the last change, e.g. by an older version
+def calendar_file(name):
+    apps = Appointment.get_current()
+    if fixed_fingerprint(apps) != read_file(os.path.join(ICS_DIR, "fingerprint")):
+        with storage_helper.exclusive():
+            write_calendars(storage_helper.load())
+
+    return read_file(os.path.join(ICS_DIR, name))
+
+
+def calendar_response(data):
+    res = make_response(data)
+    res.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+    res.headers['Content-Disposition'] = 'attachment; filename="nomaden.ics"'
+    return res
+
+
+# normally answered by nginx from ICS_DIR, see deploy/nginx-tls.cfg
 @app.route('/calendarEntry', methods=['GET'])
+@conditional_get
 def calendar_entry():
     appid = request.args.get('id')
     appo = Appointment.by_id(appid)
 
     if appo:
-        c = Calendar()
-        e = get_event(appo)
+        data = calendar_file(ics_entry_name(appo.id))
+        if data is None:
+            data = calendar_data([appo])
 
-        c.events.append(e)
-
-        res = make_response(str(c))
-        res.headers['Content-Type'] = 'text/calendar; charset=utf-8'
-        res.headers['Content-Disposition'] = 'attachment; filename="nomaden.ics"'
-
-        return res
+        return calendar_response(data)
 
 
 @app.route('/calendar', methods=['GET'])
+@conditional_get
 def calendar():
-    apps = Appointment.get_current()
+    data = calendar_file(ICS_FEED)
+    if data is None:
+        data = calendar_data(Appointment.get_current())
 
-    if len(apps) > 0:
-        c = Calendar()
-
-        for appo in apps:
-            e = get_event(appo)
-            c.events.append(e)
-
-        res = make_response(str(c))
-        res.headers['Content-Type'] = 'text/calendar; charset=utf-8'
-        res.headers['Content-Disposition'] = 'attachment; filename="nomaden.ics"'
-        return res
+    return calendar_response(data)
 
 
 # woechentlicher cronjob
@@ -683,7 +2825,7 @@ def schedule_pubs():
     for i in range(4):
         last_date = next_tuesday(last_date)
         fill_dates[last_date] = 1
-        app.logger.info("scheduling {}".format(last_date))
+        app.logger.info("scheduling %s", last_date)
 
     for appo in current_list:
         if appo.setdate in fill_dates:
@@ -714,7 +2856,8 @@ def schedule_pubs():
 
 if __name__ == "__main__":
     # initialize the log handler
-    log_handler = RotatingFileHandler(config.get('app', 'logpath', 0), maxBytes=10000, backupCount=1)
+    log_handler = RotatingFileHandler(config.get('app', 'logpath', 0),
+                                      maxBytes=10 * 1024 * 1024, backupCount=5)
     
     # set the log handler level
     log_handler.setLevel(logging.INFO)
@@ -722,5 +2865,7 @@ if __name__ == "__main__":
     # set the app logger level
     app.logger.setLevel(logging.INFO)
 
-    app.logger.addHandler(log_handler)    
+    # written by the background thread of the queue handler
+    queue_handler.handlers = [log_handler]
+    app.logger.addHandler(queue_handler)
     app.run()
@@ -19,11 +19,61 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='nomads.proto',
   package='nomadsapp',
   syntax='proto3',
-  serialized_pb=_b('\n\x0cnomads.proto\x12\tnomadsapp\"\x9a\x02\n\x0b\x41ppointment\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0e\n\x06street\x18\x02 \x01(\t\x12\x0c\n\x04\x63ity\x18\x03 \x01(\t\x12\x13\n\x0bpublictrans\x18\x04 \x01(\t\x12\x0e\n\x06source\x18\x05 \x01(\t\x12\x0f\n\x07\x65ntered\x18\x06 \x01(\t\x12\x0f\n\x07setdate\x18\x07 \x01(\t\x12\x11\n\tsortorder\x18\x08 \x01(\x05\x12\x0f\n\x07removed\x18\t \x01(\t\x12\x30\n\x08\x63omments\x18\n \x03(\x0b\x32\x1e.nomadsapp.Appointment.Comment\x12\n\n\x02id\x18\x0b \x01(\t\x1a\x36\n\x07\x43omment\x12\r\n\x05uname\x18\x01 \x01(\t\x12\x0c\n\x04text\x18\x02 \x01(\t\x12\x0e\n\x06source\x18\x03 \x01(\t\"6\n\x0e\x41ppoinmentList\x12$\n\x04\x61pps\x18\x01 \x03(\x0b\x32\x16.nomadsapp.Appointmentb\x06proto3')
+  serialized_pb=_b('\n\x0cnomads.proto\x12\tnomadsapp\"\x9a\x02\n\x0b\x41ppointment\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0e\n\x06street\x18\x02 \x01(\t\x12\x0c\n\x04\x63ity\x18\x03 \x01(\t\x12\x13\n\x0bpublictrans\x18\x04 \x01(\t\x12\x0e\n\x06source\x18\x05 \x01(\t\x12\x0f\n\x07\x65ntered\x18\x06 \x01(\t\x12\x0f\n\x07setdate\x18\x07 \x01(\t\x12\x11\n\tsortorder\x18\x08 \x01(\x05\x12\x0f\n\x07removed\x18\t \x01(\t\x12\x30\n\x08\x63omments\x18\n \x03(\x0b\x32\x1e.nomadsapp.Appointment.Comment\x12\n\n\x02id\x18\x0b \x01(\t\x1a\x36\n\x07\x43omment\x12\r\n\x05uname\x18\x01 \x01(\t\x12\x0c\n\x04text\x18\x02 \x01(\t\x12\x0e\n\x06source\x18\x03 \x01(\t\"G\n\x0e\x41ppoinmentList\x12$\n\x04\x61pps\x18\x01 \x03(\x0b\x32\x16.nomadsapp.Appointment\x12\x0f\n\x07version\x18\x02 \x01(\x04\"\x86\x01\n\x0c\x41rchiveIndex\x12\x31\n\x08segments\x18\x01 \x03(\x0b\x32\x1f.nomadsapp.ArchiveIndex.Segment\x1a\x43\n\x07Segment\x12\x0c\n\x04year\x18\x01 \x01(\x05\x12\r\n\x05\x63ount\x18\x02 \x01(\x05\x12\r\n\x05\x66irst\x18\x03 \x01(\t\x12\x0c\n\x04last\x18\x04 \x01(\t\"\xcc\x02\n\x0cJournalEntry\x12\x0b\n\x03seq\x18\x01 \x01(\x04\x12&\n\x02op\x18\x02 \x01(\x0e\x32\x1a.nomadsapp.JournalEntry.Op\x12\n\n\x02id\x18\x03 \x01(\t\x12#\n\x03\x61pp\x18\x04 \x01(\x0b\x32\x16.nomadsapp.Appointment\x12/\n\x07\x63omment\x18\x05 \x01(\x0b\x32\x1e.nomadsapp.Appointment.Comment\x12\r\n\x05\x64\x65lta\x18\x06 \x01(\x11\x12\x10\n\x08position\x18\x07 \x01(\r\x12\r\n\x05order\x18\x08 \x03(\t\"u\n\x02Op\x12\x0e\n\nCHECKPOINT\x10\x00\x12\t\n\x05\x45NTER\x10\x01\x12\n\n\x06UPDATE\x10\x02\x12\x0b\n\x07\x43OMMENT\x10\x03\x12\x08\n\x04MOVE\x10\x04\x12\x0b\n\x07\x41RCHIVE\x10\x05\x12\n\n\x06\x44\x45LETE\x10\x06\x12\x0b\n\x07MOVE_TO\x10\x07\x12\x0b\n\x07REORDER\x10\x08\"L\n\rCommentRecord\x12\n\n\x02id\x18\x01 \x01(\t\x12/\n\x07\x63omment\x18\x02 \x01(\x0b\x32\x1e.nomadsapp.Appointment.Comment\"g\n\x0cOutgoingMail\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x12\n\nrecipients\x18\x02 \x03(\t\x12\x0f\n\x07message\x18\x03 \x01(\x0c\x12\x10\n\x08\x61ttempts\x18\x04 \x01(\x05\x12\x10\n\x08retry_at\x18\x05 \x01(\x03\x62\x06proto3')
 )
 
 
 
+_JOURNALENTRY_OP = _descriptor.EnumDescriptor(
+  name='Op',
+  full_name='nomadsapp.JournalEntry.Op',
+  filename=None,
+  file=DESCRIPTOR,
+  values=[
+    _descriptor.EnumValueDescriptor(
+      name='CHECKPOINT', index=0, number=0,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='ENTER', index=1, number=1,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='UPDATE', index=2, number=2,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='COMMENT', index=3, number=3,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='MOVE', index=4, number=4,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='ARCHIVE', index=5, number=5,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='DELETE', index=6, number=6,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='MOVE_TO', index=7, number=7,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='REORDER', index=8, number=8,
+      options=None,
+      type=None),
+  ],
+  containing_type=None,
+  options=None,
+  serialized_start=738,
+  serialized_end=855,
+)
+_sym_db.RegisterEnumDescriptor(_JOURNALENTRY_OP)
+
 
 _APPOINTMENT_COMMENT = _descriptor.Descriptor(
   name='Comment',
@@ -184,6 +234,13 @@ _APPOINMENTLIST = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='version', full_name='nomadsapp.AppoinmentList.version', index=1,
+      number=2, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
   ],
   extensions=[
   ],
@@ -197,14 +254,285 @@ _APPOINMENTLIST = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=312,
-  serialized_end=366,
+  serialized_end=383,
+)
+
+
+_ARCHIVEINDEX_SEGMENT = _descriptor.Descriptor(
+  name='Segment',
+  full_name='nomadsapp.ArchiveIndex.Segment',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='year', full_name='nomadsapp.ArchiveIndex.Segment.year', index=0,
+      number=1, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='count', full_name='nomadsapp.ArchiveIndex.Segment.count', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='first', full_name='nomadsapp.ArchiveIndex.Segment.first', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='last', full_name='nomadsapp.ArchiveIndex.Segment.last', index=3,
+      number=4, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=453,
+  serialized_end=520,
+)
+
+_ARCHIVEINDEX = _descriptor.Descriptor(
+  name='ArchiveIndex',
+  full_name='nomadsapp.ArchiveIndex',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='segments', full_name='nomadsapp.ArchiveIndex.segments', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[_ARCHIVEINDEX_SEGMENT, ],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=386,
+  serialized_end=520,
+)
+
+
+_JOURNALENTRY = _descriptor.Descriptor(
+  name='JournalEntry',
+  full_name='nomadsapp.JournalEntry',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='seq', full_name='nomadsapp.JournalEntry.seq', index=0,
+      number=1, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='op', full_name='nomadsapp.JournalEntry.op', index=1,
+      number=2, type=14, cpp_type=8, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='id', full_name='nomadsapp.JournalEntry.id', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='app', full_name='nomadsapp.JournalEntry.app', index=3,
+      number=4, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='comment', full_name='nomadsapp.JournalEntry.comment', index=4,
+      number=5, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='delta', full_name='nomadsapp.JournalEntry.delta', index=5,
+      number=6, type=17, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='position', full_name='nomadsapp.JournalEntry.position', index=6,
+      number=7, type=13, cpp_type=3, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='order', full_name='nomadsapp.JournalEntry.order', index=7,
+      number=8, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+    _JOURNALENTRY_OP,
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=523,
+  serialized_end=855,
+)
+
+
+_COMMENTRECORD = _descriptor.Descriptor(
+  name='CommentRecord',
+  full_name='nomadsapp.CommentRecord',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='id', full_name='nomadsapp.CommentRecord.id', index=0,
+      number=1, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='comment', full_name='nomadsapp.CommentRecord.comment', index=1,
+      number=2, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=857,
+  serialized_end=933,
+)
+
+
+_OUTGOINGMAIL = _descriptor.Descriptor(
+  name='OutgoingMail',
+  full_name='nomadsapp.OutgoingMail',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='sender', full_name='nomadsapp.OutgoingMail.sender', index=0,
+      number=1, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='recipients', full_name='nomadsapp.OutgoingMail.recipients', index=1,
+      number=2, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='message', full_name='nomadsapp.OutgoingMail.message', index=2,
+      number=3, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='attempts', full_name='nomadsapp.OutgoingMail.attempts', index=3,
+      number=4, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='retry_at', full_name='nomadsapp.OutgoingMail.retry_at', index=4,
+      number=5, type=3, cpp_type=2, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=935,
+  serialized_end=1038,
 )
 
 _APPOINTMENT_COMMENT.containing_type = _APPOINTMENT
 _APPOINTMENT.fields_by_name['comments'].message_type = _APPOINTMENT_COMMENT
 _APPOINMENTLIST.fields_by_name['apps'].message_type = _APPOINTMENT
+_ARCHIVEINDEX_SEGMENT.containing_type = _ARCHIVEINDEX
+_ARCHIVEINDEX.fields_by_name['segments'].message_type = _ARCHIVEINDEX_SEGMENT
+_JOURNALENTRY.fields_by_name['op'].enum_type = _JOURNALENTRY_OP
+_JOURNALENTRY.fields_by_name['app'].message_type = _APPOINTMENT
+_JOURNALENTRY.fields_by_name['comment'].message_type = _APPOINTMENT_COMMENT
+_JOURNALENTRY_OP.containing_type = _JOURNALENTRY
+_COMMENTRECORD.fields_by_name['comment'].message_type = _APPOINTMENT_COMMENT
 DESCRIPTOR.message_types_by_name['Appointment'] = _APPOINTMENT
 DESCRIPTOR.message_types_by_name['AppoinmentList'] = _APPOINMENTLIST
+DESCRIPTOR.message_types_by_name['ArchiveIndex'] = _ARCHIVEINDEX
+DESCRIPTOR.message_types_by_name['JournalEntry'] = _JOURNALENTRY
+DESCRIPTOR.message_types_by_name['CommentRecord'] = _COMMENTRECORD
+DESCRIPTOR.message_types_by_name['OutgoingMail'] = _OUTGOINGMAIL
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 Appointment = _reflection.GeneratedProtocolMessageType('Appointment', (_message.Message,), dict(
@@ -229,5 +557,41 @@ AppoinmentList = _reflection.GeneratedProtocolMessageType('AppoinmentList', (_me
   ))
 _sym_db.RegisterMessage(AppoinmentList)
 
+ArchiveIndex = _reflection.GeneratedProtocolMessageType('ArchiveIndex', (_message.Message,), dict(
+
+  Segment = _reflection.GeneratedProtocolMessageType('Segment', (_message.Message,), dict(
+    DESCRIPTOR = _ARCHIVEINDEX_SEGMENT,
+    __module__ = 'nomads_pb2'
+    # @@protoc_insertion_point(class_scope:nomadsapp.ArchiveIndex.Segment)
+    ))
+  ,
+  DESCRIPTOR = _ARCHIVEINDEX,
+  __module__ = 'nomads_pb2'
+  # @@protoc_insertion_point(class_scope:nomadsapp.ArchiveIndex)
+  ))
+_sym_db.RegisterMessage(ArchiveIndex)
+_sym_db.RegisterMessage(ArchiveIndex.Segment)
+
+JournalEntry = _reflection.GeneratedProtocolMessageType('JournalEntry', (_message.Message,), dict(
+  DESCRIPTOR = _JOURNALENTRY,
+  __module__ = 'nomads_pb2'
+  # @@protoc_insertion_point(class_scope:nomadsapp.JournalEntry)
+  ))
+_sym_db.RegisterMessage(JournalEntry)
+
+CommentRecord = _reflection.GeneratedProtocolMessageType('CommentRecord', (_message.Message,), dict(
+  DESCRIPTOR = _COMMENTRECORD,
+  __module__ = 'nomads_pb2'
+  # @@protoc_insertion_point(class_scope:nomadsapp.CommentRecord)
+  ))
+_sym_db.RegisterMessage(CommentRecord)
+
+OutgoingMail = _reflection.GeneratedProtocolMessageType('OutgoingMail', (_message.Message,), dict(
+  DESCRIPTOR = _OUTGOINGMAIL,
+  __module__ = 'nomads_pb2'
+  # @@protoc_insertion_point(class_scope:nomadsapp.OutgoingMail)
+  ))
+_sym_db.RegisterMessage(OutgoingMail)
+
 
 # @@protoc_insertion_point(module_scope)
@@ -0,0 +1,231 @@
+# helpers for streams of length delimited protobuf records, every
+# record is the varint encoded size of the message followed by the
+# serialized message itself. a repeated message field is much the
+# same, every record has the field's tag in front.
+
+import struct
+
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+# decode the varint starting at pos, returns (value, position after
+# the varint), raises IndexError if buf ends in the middle of it
+def decode_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        value |= (b & 0x7f) << shift
+        pos += 1
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def delimited(msg):
+    data = msg.SerializeToString()
+    return encode_varint(len(data)) + data
+
+
+# msg as a field of another message. writing these one after another
+# writes a message with a repeated field, e.g. an AppoinmentList, one
+# element at a time.
+def tagged(number, msg):
+    data = msg.SerializeToString()
+    return encode_varint(number << 3 | 2) + encode_varint(len(data)) + data
+
+
+# read a varint from a file, None at the end of the file or if the
+# file ends in the middle of it
+def read_varint(f):
+    value = 0
+    shift = 0
+    while True:
+        b = f.read(1)
+        if not b:
+            return None
+        b = ord(b)
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value
+        shift += 7
+
+
+# read the records of a stream of length delimited records from a file
+# one at a time, a record cut off at the end is left out
+def read_delimited(f):
+    while True:
+        length = read_varint(f)
+        if length is None:
+            return
+        data = f.read(length)
+        if len(data) < length:
+            return
+        yield data
+
+
+# read the top level fields of a message from a file one at a time,
+# yields (field number, data) of the length delimited fields, other
+# fields are skipped. a field cut off at the end is left out.
+def read_fields(f):
+    while True:
+        key = read_varint(f)
+        if key is None:
+            return
+        wire = key & 7
+        if wire == 0:
+            if read_varint(f) is None:
+                return
+        elif wire == 1:
+            f.read(8)
+        elif wire == 5:
+            f.read(4)
+        elif wire == 2:
+            length = read_varint(f)
+            if length is None:
+                return
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield key >> 3, data
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire))
+
+
+# yield (start, end) of every complete record in buf. a record cut off
+# at the end of buf, e.g. by a crashed or concurrent writer, is not
+# reported, so the end of the last record is where the next one goes.
+def iter_delimited(buf, pos=0):
+    size = len(buf)
+    while pos < size:
+        try:
+            length, start = decode_varint(buf, pos)
+        except IndexError:
+            return
+        end = start + length
+        if end > size:
+            return
+        yield start, end
+        pos = end
+
+
+# yield (field number, wire type, start, end) of the top level fields
+# of a serialized message, start and end delimit the value, without
+# the length of length delimited fields
+def iter_fields(buf, pos=0):
+    size = len(buf)
+    while pos < size:
+        key, pos = decode_varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            start = pos
+            pos = decode_varint(buf, pos)[1]
+        elif wire == 1:
+            start = pos
+            pos += 8
+        elif wire == 2:
+            length, start = decode_varint(buf, pos)
+            pos = start + length
+        elif wire == 5:
+            start = pos
+            pos += 4
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire))
+        yield key >> 3, wire, start, pos
+
+
+# the value of a varint field of a serialized message, default if it
+# is not set
+def varint_field(buf, number, default=0):
+    value = default
+    for field, wire, start, end in iter_fields(buf):
+        if field == number and wire == 0:
+            value = decode_varint(buf, start)[0]
+    return value
+
+
+OFFSETS = struct.Struct('<QQ')
+SIZE = struct.Struct('<Q')
+
+
+# the offsets of the records of a repeated field, so that RecordList
+# doesn't need to scan for them: the size of the serialized message
+# followed by start and end of every record
+def record_index(buf, number):
+    out = [SIZE.pack(len(buf))]
+    for field, wire, start, end in iter_fields(buf):
+        if field == number and wire == 2:
+            out.append(OFFSETS.pack(start, end))
+    return b''.join(out)
+
+
+# the messages of a repeated field of a serialized message, e.g. the
+# apps of an AppoinmentList in a memory mapped file. a message is
+# decoded each time it is accessed. the offsets are taken from index,
+# as written by record_index, if it belongs to buf, otherwise buf is
+# scanned for them.
+class RecordList():
+
+    def __init__(self, buf, number, message, index=b''):
+        if len(index) < SIZE.size or\
+           SIZE.unpack_from(index)[0] != len(buf) or\
+           (len(index) - SIZE.size) % OFFSETS.size:
+            index = record_index(buf, number)
+        self.buf = buf
+        self.message = message
+        self.index = index
+        self.count = (len(index) - SIZE.size) // OFFSETS.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.count))]
+        return self.message.FromString(self.record(idx))
+
+    # the serialized message at idx
+    def record(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        start, end = OFFSETS.unpack_from(
+            self.index, SIZE.size + OFFSETS.size * idx)
+        return self.buf[start:end]
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+
+# writes serialized messages to a file as a repeated field one at a
+# time and keeps their record index
+class RecordWriter():
+
+    def __init__(self, f, number):
+        self.f = f
+        self.tag = encode_varint(number << 3 | 2)
+        self.pos = 0
+        self.offsets = bytearray()
+
+    def write(self, data):
+        head = self.tag + encode_varint(len(data))
+        self.f.write(head)
+        self.f.write(data)
+        start = self.pos + len(head)
+        self.pos = start + len(data)
+        self.offsets.extend(OFFSETS.pack(start, self.pos))
+
+    def index(self):
+        return SIZE.pack(self.pos) + bytes(self.offsets)